@@ -28,13 +28,21 @@ import discord
 import func_strings as f
 
 from store import Store
+from sqlite_store import SqliteStore
+from async_store import AsyncStore
 from config import Config
 from permissions import Permissions
-from utils import make_print, new_line
+from utils import make_print, DEBUG
 from arguments import Arguments
 from embed import Embed
 from bot import Bot
 from server import Server
+from scheduler import Scheduler
+from intake import Intake
+from events import Broadcaster
+from metrics import handled, watch_loop_lag
+from tracing import TRACER, traced
+from logs import start_logging, configure_logging
 
 
 def print(*args, **kwargs):
@@ -48,34 +56,47 @@ def exit_bot():
     sys.exit(0)
 
 
-async def main(client, store, args, config, embed, bot):
+async def main(client, store, args, config, embed, bot, intake):
     """Instantiate classes and run the bot"""
     @client.event
+    @handled
+    @traced
     async def on_member_update(before, after):
-        """Validates new users
-        Tracks and updates name changes
-        Kicks unauthorized users
-        Removes / adds roles as needed
-        """
+        """Keeps the member index fresh, the rest goes trough intake"""
         if not before or not after:
             return  # Probably called, before the bot is ready
 
+        bot.index_member(after)
+
         if before.bot or after.bot:
             return
 
+        if bot.raid.holds(after.id):
+            return  # Waiting in the admission queue
+
+        await intake.submit(before, after)
+
+    @traced
+    async def handle_member_update(before, after):
+        """Validates new users
+        Tracks and updates name changes
+        Kicks unauthorized users
+        Removes / adds roles as needed
+        """
         # Create a DB entry for every new user
-        if store.make_user_blank_entry(after):
+        if await store.make_user_blank_entry(after):
             print(f'Created an empty DB entry for {after}')
 
         if str(before) != str(after) or \
-                store.is_new_name(after.id, str(after)):
+                await store.is_new_name(after.id, str(after)):
             print(f'Name update detected, {before.name} > {after.name}')
             print(f'Updating DB entry name of {after.id} to {after}')
-            store.update_user_entry(after)
+            await store.update_user_entry(after)
 
-        if not store.is_valid(after):
-            print(f'Updating an invalidated DB entry, ID - {after}')
-            store.update_user_entry(after)
+        if not await store.is_valid(after):
+            print(f'Updating an invalidated DB entry, ID - {after}',
+                  level=DEBUG)
+            await store.update_user_entry(after)
 
         # Avoid unnecessary calculations below
         if before.status == after.status:
@@ -103,10 +124,10 @@ async def main(client, store, args, config, embed, bot):
             await bot.request_key(after)
             return
 
-        is_approved = store.is_approved(after)
+        is_approved = await store.is_approved(after)
 
         # Handle a real user
-        if not is_approved and store.get_user_key(after):
+        if not is_approved and await store.has_key(after):
             print(f'Unapproved {after} connected, requesting the key')
             await bot.request_key(after)
         elif not is_approved and not after.bot:
@@ -118,22 +139,56 @@ async def main(client, store, args, config, embed, bot):
                 await bot.kick(after)
             else:
                 await bot.remove_role(after, config.roles['approved']['ref'])
+                bot.reconciled.add(after.id)
         elif is_approved:
             # Ensure the user has "Approved role"
             if not bot.has_approved_role(after):
                 print(f'{after} is missing "Approved" role, fixing…')
                 await bot.add_role(after, config.roles['approved']['ref'])
 
+            bot.reconciled.add(after.id)
+
     @client.event
+    @handled
+    @traced
+    async def on_member_join(member):
+        """Index the new member for lookups"""
+        bot.index_member(member)
+
+        if not member.bot and bot.raid.admit(member):
+            print(f'{member} joined during a raid, queued for admission')
+
+    @client.event
+    @handled
+    @traced
     async def on_member_remove(member):
         """Invalidate members DB entry, when it leaves the server"""
         print(f'{member} removed from the server')
-        if store.is_approved(member) or store.get_user_key(member):
-            store.invalidate(member, True)  # True = keep the key
+        bot.unindex_member(member)
+        bot.router.cancel(member.id)  # Nobody left to validate
+        bot.raid.discard(member.id)
+        bot.reconciled.discard(member.id)  # Swept again, if it rejoins
+        intake.discard(member.id)  # Held updates would undo the removal
+        await bot.pipeline.submit(member.id, handle_member_remove, member)
+
+    @traced
+    async def handle_member_remove(member):
+        """Invalidates the entry, in order with the members other events"""
+        if await store.is_approved(member) \
+           or await store.has_key(member):
+            await store.invalidate(member, True)  # True = keep the key
 
     @client.event
+    @handled
+    @traced
     async def on_member_ban(member):
         """Delete the user from the database"""
+        intake.discard(member.id)
+        await bot.pipeline.submit(member.id, handle_member_ban, member)
+
+    @traced
+    async def handle_member_ban(member):
+        """Deletes the entry, in order with the members other events"""
         print(f'{member} got banned, deleting from the database')
         success = await store.remove_user_by_id(member.id)
 
@@ -141,9 +196,10 @@ async def main(client, store, args, config, embed, bot):
             print(f'{member} deleted successfully')
 
     @client.event
+    @handled
+    @traced
     async def on_ready():
         """Sets default username and picture"""
-        new_line()
         print('Connection successful')
         print('Bot logged in as ' + client.user.name + '\n')
 
@@ -157,8 +213,14 @@ async def main(client, store, args, config, embed, bot):
             await bot.sweep_server()
 
     @client.event
+    @handled
+    @traced
     async def on_message(message):
         """Listens for bot commands"""
+        # Keys awaited by request_key() go to their validations
+        if bot.router.route(message):
+            return
+
         if isinstance(message, discord.Channel):
             if message.server != config.server:
                 print('Message received from an unauthorized channel')
@@ -178,9 +240,9 @@ async def main(client, store, args, config, embed, bot):
             # Also request the key right away, incase the user is sitting
             # in the server and --no-kick is on
             if member and member.status != discord.Status.offline \
-               and not store.is_approved(member):
+               and not await store.is_approved(member):
                 print(f'{member} is online, requesting key right away')
-                await bot.request_key(member)
+                await bot.queue_request_key(member)
 
         # !approve
         elif message.content.startswith(f.APPROVE):
@@ -209,7 +271,7 @@ async def main(client, store, args, config, embed, bot):
             await embed.nm_approved(
                 message.channel,
                 message.author,
-                store.is_approved(message.author))
+                await store.is_approved(message.author))
 
         # Returns a response, if the message.author has permissions
         # to use the bot
@@ -222,7 +284,41 @@ async def main(client, store, args, config, embed, bot):
             if status:
                 await embed.hey(message)
 
+        # !raid, !raid on, !raid off
+        elif message.content.startswith(f.RAID):
+            if not config.is_admin(message.author):
+                print(f'{message.author} tried to execute {f.RAID}')
+                return
+
+            mode = message.content[len(f.RAID):].strip()
+
+            if mode == 'on':
+                bot.raid.engage(manual=True)
+            elif mode == 'off':
+                bot.raid.disengage()
+
+            await embed.nm_raid(message.channel, bot.raid.stats())
+
+        # !stats
+        elif message.content.startswith(f.STATS):
+            if not config.is_admin(message.author):
+                print(f'{message.author} tried to execute {f.STATS}')
+                return
+
+            await embed.nm_stats(message.channel, TRACER.stats())
+
+        # !reconcile
+        elif message.content.startswith(f.RECONCILE):
+            if not config.is_admin(message.author):
+                print(f'{message.author} tried to execute {f.RECONCILE}')
+                return
+
+            result = await bot.reconciler.reconcile()
+            await embed.nm_reconciled(message.channel, result)
+
     @client.event
+    @handled
+    @traced
     async def on_server_role_update(old, new):
         """Maintain references to roles, as they change"""
         if old.server.id != config.server_id:
@@ -236,6 +332,8 @@ async def main(client, store, args, config, embed, bot):
             await bot.sweep_bans()
 
     @client.event
+    @handled
+    @traced
     async def on_server_role_delete(role):
         """Pause the bot, if a reference to a role is lost"""
         if role.server.id != config.server_id:
@@ -245,12 +343,16 @@ async def main(client, store, args, config, embed, bot):
         await config.on_delete_role(role)
 
     @client.event
+    @handled
+    @traced
     async def on_server_role_create(role):
         """Server role added"""
         print(f'New role detected - {role.name}')
         config.lock_role(role)
 
     @client.event
+    @handled
+    @traced
     async def on_server_unavailable(server):
         """Pause the bot, when the target server becomes unavailable"""
         if server.id == config.server_id:
@@ -260,9 +362,12 @@ async def main(client, store, args, config, embed, bot):
             exit_bot()
 
     @client.event
+    @handled
+    @traced
     async def on_server_available(server):
         """Resume the bot, when the target server becomes available"""
         main_server_found = False
+        bot.index_server(server)
 
         if server.id == config.server_id:
             main_server_found = True
@@ -270,7 +375,6 @@ async def main(client, store, args, config, embed, bot):
 
             print(f'Target server, {server.name} has become available')
 
-            new_line()
             await config.lock_roles(server)
 
             for i in config.roles:
@@ -281,7 +385,21 @@ async def main(client, store, args, config, embed, bot):
         if not main_server_found:
             print('Still waiting for the server specified in the config file…')
 
+    async def flush_store():
+        """Flushes DB changes, that are waiting for the sync interval"""
+        while True:
+            await asyncio.sleep(args.sync_interval)
+            await store.sync()
+
     # Callbacks end
+    intake.listen(lambda before, after: bot.pipeline.submit(
+        after.id, handle_member_update, before, after))
+    asyncio.ensure_future(flush_store())
+    asyncio.ensure_future(watch_loop_lag())
+    bot.scheduler.start()
+    bot.pipeline.start()
+    bot.raid.start()
+    bot.reconciler.start()
     connected = False
 
     while not connected:
@@ -296,17 +414,40 @@ async def main(client, store, args, config, embed, bot):
 
 def init():
     """Handle discord.Client() with care"""
+    start_logging()  # Written off the loop thread
+
     client = discord.Client()
     loop = asyncio.get_event_loop()
 
     # Local classes
     args = Arguments(sys.argv[1:])
+    configure_logging(args.log_level, args.log_json)
     permissions = Permissions()
     config = Config(args, permissions)
-    store = Store()
-    embed = Embed(client, config, args)
-    bot = Bot(client, store, config, embed, permissions, args)
-    server = Server(loop, store, config, bot)  # Server goes live on init
+
+    # Store calls run on their own thread, trough the AsyncStore facade
+    if args.db_backend == 'sqlite':
+        store = AsyncStore(SqliteStore(args), loop)
+    else:
+        store = AsyncStore(Store(args), loop)
+
+    events = Broadcaster(loop)  # Store changes, for /events
+    store.subscribe(events.publish)
+
+    scheduler = Scheduler(client)
+    embed = Embed(client, config, args, scheduler)
+    bot = Bot(client, store, config, embed, permissions, args, scheduler)
+    intake = Intake(store, args, bot)  # Filters @on_member_update
+    store.subscribe(bot.waiters.on_store_event)
+    server = Server(loop, store, config, bot, intake, events)  # Live now
+
+    if args.trace:  # Opt-in, wraps the methods on these instances
+        TRACER.enable(args.slow_event_ms)
+        TRACER.instrument(store, 'store', 'Store')
+        TRACER.instrument(bot, 'bot', 'Bot')
+        TRACER.instrument(embed, 'embed', 'Embed')
+        TRACER.instrument(scheduler, 'discord', 'Discord', (
+            'add_role', 'remove_role', 'kick', 'send_message'))
 
     if not args.instantiated or not config.instantiated:
         loop.run_until_complete(client.close())
@@ -314,10 +455,14 @@ def init():
 
     try:
         loop.run_until_complete(
-            main(client, store, args, config, embed, bot))
+            main(client, store, args, config, embed, bot, intake))
     except KeyboardInterrupt:
         loop.run_until_complete(client.close())
     finally:
+        store.close()  # Flush whatever is left in the write-back cache
+        bot.router.close()  # Pending validations resume on next start
+        # Next start only sweeps what changes after, or wasn't handled
+        bot.save_snapshot(intake.pending.keys())
         loop.close()
 
 
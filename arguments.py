@@ -25,6 +25,7 @@ import argparse
 
 from pathlib import Path
 from utils import NAME, DESCRIPTION, make_print
+from logs import LEVELS
 
 
 def print(*args, **kwargs):
@@ -32,6 +33,9 @@ def print(*args, **kwargs):
     return make_print('Args', *args, **kwargs)
 
 
+BACKENDS = ('file', 'sqlite')
+
+
 class Arguments:
     """Process and store arguments"""
     def __init__(self, argv):
@@ -41,11 +45,27 @@ class Arguments:
         self.print_stats_only = False
         self.kick = True
         self.config_path = None
-        self.db_backend = None  # TODO
+        self.db_backend = 'file'
         self.timeout_time = 60
+        self.sync_interval = 5
+        self.sync_limit = 100
+        self.sweep_workers = 8
+        self.full_sweep = False
+        self.reconcile_interval = 300
+        self.reconcile_budget = 50
+        self.debounce_window = 0.5
+        self.pipeline_workers = 16
+        self.pipeline_limit = 1000
+        self.raid_joins = 20
+        self.raid_window = 10
+        self.raid_rate = 1
         self.prevent_admin_role = False
         self.server_ip = None
         self.server_port = None
+        self.log_level = 'info'
+        self.log_json = False
+        self.trace = False
+        self.slow_event_ms = 250
 
         self.argv = argv
         self.args = self.create_arguments()
@@ -63,7 +83,7 @@ class Arguments:
                          help='Override default config location')
 
         arg.add_argument('-b', '--backend', metavar='file',
-                         help='Currently the only supported backend is "file"')
+                         help='DB backend, "file" or "sqlite"')
 
         arg.add_argument('-i', '--info', action='store_true',
                          help='Logs into the bot and prints out servers, roles'
@@ -72,12 +92,60 @@ class Arguments:
         arg.add_argument('-t', '--timeout', metavar='60',
                          help='Seconds before kick. 0 means no kick')
 
+        arg.add_argument('--sync-interval', metavar='5',
+                         help='Seconds between DB flushes to disk')
+
+        arg.add_argument('--sync-limit', metavar='100',
+                         help='Flush the DB early, after this many changes')
+
+        arg.add_argument('--sweep-workers', metavar='8',
+                         help='Members handled at once, during a sweep')
+
+        arg.add_argument('--full-sweep', action='store_true',
+                         help='Sweep every member, ignoring the snapshot')
+
+        arg.add_argument('--reconcile-interval', metavar='300',
+                         help='Seconds between role reconciliations. 0 is off')
+
+        arg.add_argument('--reconcile-budget', metavar='50',
+                         help='Role changes per periodic reconciliation')
+
+        arg.add_argument('--debounce', metavar='0.5',
+                         help='Seconds to coalesce member updates for')
+
+        arg.add_argument('--pipeline-workers', metavar='16',
+                         help='Members, whose events are handled at once')
+
+        arg.add_argument('--pipeline-limit', metavar='1000',
+                         help='Queued member events, before intake waits')
+
+        arg.add_argument('--raid-joins', metavar='20',
+                         help='Joins within --raid-window, starting raid mode')
+
+        arg.add_argument('--raid-window', metavar='10',
+                         help='Seconds of joins, that count towards a raid')
+
+        arg.add_argument('--raid-rate', metavar='1',
+                         help='Members admitted per second, during a raid')
+
         arg.add_argument('-k', '--no-kick', action='store_true',
                          help='Disable kick on invalid keys')
 
         arg.add_argument('--no-admin-role', action='store_true',
                          help='Ignore admin role permissions')
 
+        arg.add_argument('--log-level', metavar='info',
+                         help='debug, info, warning or error')
+
+        arg.add_argument('--log-json', action='store_true',
+                         help='Log JSON lines, instead of plain text')
+
+        arg.add_argument('--trace', action='store_true',
+                         help='Trace handler, store and Discord latencies')
+
+        arg.add_argument('--slow-event-ms', metavar='250',
+                         help='Log a breakdown of traced events over this')
+
         arg.add_argument('--ip', metavar='127.0.0.1',
                          help='API server ip')
 
@@ -95,11 +163,12 @@ class Arguments:
             print(f'Config path changed to {str(self.config_path)}')
 
         if self.args.backend:
-            if self.args.backend != 'file':
+            if self.args.backend not in BACKENDS:
                 print(f'Backend "{self.args.backend}" is not supported')
                 errors += 1
             else:
                 self.db_backend = self.args.backend
+                print(f'Using the "{self.db_backend}" backend')
 
         if self.args.info:
             self.print_stats_only = True
@@ -108,6 +177,55 @@ class Arguments:
             self.timeout_time = int(self.args.timeout)
             print(f'Timeout set to {self.timeout_time}')
 
+        if self.args.sync_interval:
+            self.sync_interval = float(self.args.sync_interval)
+            print(f'DB sync interval set to {self.sync_interval}')
+
+        if self.args.sync_limit:
+            self.sync_limit = int(self.args.sync_limit)
+            print(f'DB sync limit set to {self.sync_limit}')
+
+        if self.args.sweep_workers:
+            self.sweep_workers = max(1, int(self.args.sweep_workers))
+            print(f'Sweep workers set to {self.sweep_workers}')
+
+        if self.args.full_sweep:
+            self.full_sweep = True
+            print('Snapshot ignored, sweeping every member')
+
+        if self.args.reconcile_interval:
+            self.reconcile_interval = float(self.args.reconcile_interval)
+            print('Reconciliation interval set to '
+                  + str(self.reconcile_interval))
+
+        if self.args.reconcile_budget:
+            self.reconcile_budget = max(1, int(self.args.reconcile_budget))
+            print(f'Reconciliation budget set to {self.reconcile_budget}')
+
+        if self.args.debounce:
+            self.debounce_window = max(0, float(self.args.debounce))
+            print(f'Debounce window set to {self.debounce_window}')
+
+        if self.args.pipeline_workers:
+            self.pipeline_workers = max(1, int(self.args.pipeline_workers))
+            print(f'Pipeline workers set to {self.pipeline_workers}')
+
+        if self.args.pipeline_limit:
+            self.pipeline_limit = max(1, int(self.args.pipeline_limit))
+            print(f'Pipeline limit set to {self.pipeline_limit}')
+
+        if self.args.raid_joins:
+            self.raid_joins = max(1, int(self.args.raid_joins))
+            print(f'Raid join threshold set to {self.raid_joins}')
+
+        if self.args.raid_window:
+            self.raid_window = max(0.1, float(self.args.raid_window))
+            print(f'Raid window set to {self.raid_window}')
+
+        if self.args.raid_rate:
+            self.raid_rate = max(0.01, float(self.args.raid_rate))
+            print(f'Raid admission rate set to {self.raid_rate}')
+
         if self.args.no_kick:
             self.kick = False
             print('Kick disabled')
@@ -116,6 +234,24 @@ class Arguments:
             self.prevent_admin_role = True
             print("Admin role won't be able to interact with the bot")
 
+        if self.args.log_level:
+            if self.args.log_level not in LEVELS:
+                print(f'Log level "{self.args.log_level}" is not supported')
+                errors += 1
+            else:
+                self.log_level = self.args.log_level
+
+        if self.args.log_json:
+            self.log_json = True
+
+        if self.args.trace:
+            self.trace = True
+            print('Tracing enabled')
+
+        if self.args.slow_event_ms:
+            self.slow_event_ms = float(self.args.slow_event_ms)
+            print(f'Slow event threshold set to {self.slow_event_ms}ms')
+
         if self.args.ip:
             self.server_ip = self.args.ip
             print('API IP changed to ' + self.server_ip)
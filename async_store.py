@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import make_print
+from metrics import STORE_SECONDS
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('AsyncStore', *args, **kwargs)
+
+
+class AsyncStore:
+    """Awaitable facade around Store
+
+    Every call runs on a single store thread, so disk reads, writes and
+    syncs don't block the event loop. One thread also serializes all the
+    writes, the backends don't need any locking
+
+    Predicates answered by the in-memory index of Store run right on the
+    loop, there's no disk to wait for
+    """
+    def __init__(self, store, loop):
+        self.store = store
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        print(f'Store running on its own thread, {type(store).__name__}')
+
+    def run(self, method, *args):
+        """Schedules method(*args) on the store thread"""
+        started = time.monotonic()
+        future = self.loop.run_in_executor(self.executor, method, *args)
+        future.add_done_callback(lambda _: STORE_SECONDS.observe(
+            time.monotonic() - started, method.__name__))
+
+        return future
+
+    def close(self):
+        """Waits for queued calls, then flushes and closes the store
+
+        Called after the event loop has stopped
+        """
+        self.executor.shutdown(wait=True)
+        self.store.close()
+
+    async def sync(self):
+        """Store.sync() on the store thread"""
+        return await self.run(self.store.sync)
+
+    async def flush(self):
+        """Store.flush() on the store thread"""
+        return await self.run(self.store.flush)
+
+    async def get_approved_users(self):
+        """Store.get_approved_users() on the store thread"""
+        return await self.run(self.store.get_approved_users)
+
+    async def remove_user(self, target):
+        """Store.remove_user() on the store thread"""
+        return await self.run(self.store.remove_user, target)
+
+    async def remove_user_by_id(self, user_id):
+        """Store.remove_user_by_id() on the store thread"""
+        return await self.run(self.store.remove_user_by_id, user_id)
+
+    async def remove_users_by_id(self, user_ids):
+        """Store.remove_users_by_id() on the store thread"""
+        return await self.run(self.store.remove_users_by_id, user_ids)
+
+    async def add_user(self, user, approve=False):
+        """Store.add_user() on the store thread"""
+        return await self.run(self.store.add_user, user, approve)
+
+    async def make_user_blank_entry(self, member):
+        """Store.make_user_blank_entry() on the store thread
+
+        Only goes to the store thread, if there's an entry to create
+        """
+        if self.store.has_entry(member.id):
+            return False
+        return await self.run(self.store.make_user_blank_entry, member)
+
+    async def add_users(self, user_ids, approve=False):
+        """Store.add_users() on the store thread"""
+        return await self.run(self.store.add_users, user_ids, approve)
+
+    async def get_users(self, user_ids):
+        """Store.get_users() on the store thread"""
+        return await self.run(self.store.get_users, user_ids)
+
+    async def page(self, cursor=None, limit=100, mask=0, expected=0):
+        """Store.page() on the store thread"""
+        return await self.run(
+            self.store.page, cursor, limit, mask, expected)
+
+    def subscribe(self, listener):
+        """Store.subscribe(), listener gets called on the store thread"""
+        self.store.subscribe(listener)
+
+    async def has_entry(self, user_id):
+        """Store.has_entry(), answered from memory"""
+        return self.store.has_entry(user_id)
+
+    async def has_key(self, member):
+        """Store.has_key(), answered from memory"""
+        return self.store.has_key(member)
+
+    async def get_user_key(self, member):
+        """Store.get_user_key() on the store thread"""
+        return await self.run(self.store.get_user_key, member)
+
+    async def is_valid(self, member):
+        """Store.is_valid(), answered from memory"""
+        return self.store.is_valid(member)
+
+    async def is_approved(self, member):
+        """Store.is_approved(), answered from memory"""
+        return self.store.is_approved(member)
+
+    async def approved_ids(self):
+        """Store.approved_ids() on the store thread
+
+        Iterates the index, which the store thread keeps growing
+        """
+        return await self.run(self.store.approved_ids)
+
+    async def get_user(self, user):
+        """Store.get_user() on the store thread"""
+        return await self.run(self.store.get_user, user)
+
+    async def get_user_id(self, name):
+        """Store.get_user_id() on the store thread"""
+        return await self.run(self.store.get_user_id, name)
+
+    async def does_key_match(self, user, key):
+        """Store.does_key_match() on the store thread"""
+        return await self.run(self.store.does_key_match, user, key)
+
+    async def invalidate(self, member, keep_key=False):
+        """Store.invalidate() on the store thread"""
+        return await self.run(self.store.invalidate, member, keep_key)
+
+    async def update_name(self, user_id, new_name):
+        """Store.update_name() on the store thread"""
+        return await self.run(self.store.update_name, user_id, new_name)
+
+    async def is_new_name(self, user_id, current_name):
+        """Store.is_new_name(), answered from memory"""
+        return self.store.is_new_name(user_id, current_name)
+
+    async def get_user_by_id(self, user_id):
+        """Store.get_user_by_id() on the store thread"""
+        return await self.run(self.store.get_user_by_id, user_id)
+
+    async def update_user_entry(self, member, entry=None):
+        """Store.update_user_entry() on the store thread"""
+        return await self.run(self.store.update_user_entry, member, entry)
@@ -21,9 +21,27 @@ THE SOFTWARE.
 """
 
 # pylint: disable=redefined-builtin, import-error, too-many-instance-attributes, too-many-arguments, too-many-return-statements
+import time
+import asyncio
+import collections
 import discord
 
-from utils import make_print, is_id
+from utils import (
+    PENDING_PATH,
+    BANS_PATH,
+    SNAPSHOT_PATH,
+    DEBUG,
+    WARNING,
+    make_print,
+    is_id
+)
+from state import load_state, save_state
+from router import DmRouter, CANCELLED
+from reconcile import Reconciler
+from pipeline import Pipeline
+from raid import RaidGuard
+from waiters import Waiters
+from metrics import SWEEP_SECONDS
 
 
 def print(*args, **kwargs):
@@ -31,32 +49,102 @@ def print(*args, **kwargs):
     return make_print('Bot', *args, **kwargs)
 
 
+SWEEP_PROGRESS = 250  # Print sweep progress every this many members
+
+
 class Bot:
     """Client object for discord.Client"""
-    def __init__(self, client, store, config, embed, permissions, args):
+    def __init__(self, client, store, config, embed, permissions, args,
+                 scheduler):
         """Instantiate"""
         self.client = client
+        self.scheduler = scheduler  # Outbound kicks and role changes
         self.store = store
         self.config = config
         self.embed = embed
         self.permissions = permissions
         self.args = args
 
-        # Holds ID's to users, the bot currently awaits a key from
+        # Holds validations of users, the bot currently awaits a key from
         # Used to prevent multiple requests, during @on_member_updated
-        self.pending_users = []
+        self.router = DmRouter(PENDING_PATH, store.run)
+
+        # Member events and validations, in order, per member
+        self.pipeline = Pipeline(args)
+
+        # Long-polls, waiting for validations to finish
+        self.waiters = Waiters(asyncio.get_event_loop())
+
+        # Admission queue for joins, during a raid
+        self.raid = RaidGuard(self, store, args)
+
+        # Keeps the "Approved" role in line with the DB
+        self.reconciler = Reconciler(self, store, config, args)
+
+        # Server snapshot is only worth saving after a sweep
+        self.swept = False
+
+        # IDs of members the bot has validated, kicked or found approved,
+        # only those go into the snapshot
+        self.reconciled = set()
 
         # If initial sweep has no permissions, queue up one, incase
         # the bot ever receives those permissions
         self.sweep_bans_needed = False
 
+        # Member lookup index, kept up to date from the member events
+        self.members = {}  # ID -> member
+        self.member_ids = {}  # Name#1234 -> ID
+        self.member_names = {}  # ID -> Name#1234
+
+    def index_member(self, member):
+        """Adds member to the lookup index, or refreshes its name
+
+        If the same user is in several servers the bot can see, member
+        of the configured server takes priority
+        """
+        indexed = self.members.get(member.id)
+
+        if indexed is not None \
+           and indexed.server.id == self.config.server_id \
+           and member.server.id != self.config.server_id:
+            return
+
+        name = str(member)
+        old_name = self.member_names.get(member.id)
+
+        if old_name != name and self.member_ids.get(old_name) == member.id:
+            del self.member_ids[old_name]
+
+        self.members[member.id] = member
+        self.member_ids[name] = member.id
+        self.member_names[member.id] = name
+
+    def unindex_member(self, member):
+        """Removes member from the lookup index, if it left the server,
+        it was indexed from
+        """
+        indexed = self.members.get(member.id)
+
+        if indexed is None or indexed.server.id != member.server.id:
+            return
+
+        del self.members[member.id]
+        name = self.member_names.pop(member.id)
+
+        if self.member_ids.get(name) == member.id:
+            del self.member_ids[name]
+
+    def index_server(self, server):
+        """Adds every member of server to the lookup index"""
+        for member in server.members:
+            self.index_member(member)
+
+        print(f'Indexed {len(server.members)} members of {server.name}')
+
     def currently_validating(self, user_id):
         """Returns true, if bot is awaiting a key from the user ID"""
-        try:
-            self.pending_users.index(user_id)
-            return True
-        except ValueError:
-            return False
+        return user_id in self.router
 
     async def set_defaults(self):
         """Currently only sets default username"""
@@ -83,9 +171,10 @@ class Bot:
         try:
             if member.id != self.config.owner_id \
                and member != self.config.server.owner:
-                await self.client.kick(member)
+                await self.scheduler.kick(member)
         except discord.Forbidden:
-            print(f"Bot didn't have permissions to kick {member}")
+            print(f"Bot didn't have permissions to kick {member}",
+                  level=WARNING)
         except AttributeError:
             pass  # Couldn't find the user
 
@@ -115,11 +204,13 @@ class Bot:
 
         if not role:
             print(f'Adding a role to {member} failed! Reference missing')
+            return
 
         try:
-            await self.client.add_roles(member, role)
+            await self.scheduler.add_role(member, role)
         except discord.Forbidden:
-            print(f"Bot didn't have permissions to add a role to {member}")
+            print(f"Bot didn't have permissions to add a role to {member}",
+                  level=WARNING)
 
     async def remove_role(self, member, role):
         """Removes the accepted role
@@ -133,17 +224,19 @@ class Bot:
 
         if not role:
             print(f'Removing a role from {member} failed! Reference missing')
+            return
 
         try:
-            await self.client.remove_roles(member, role)
+            await self.scheduler.remove_role(member, role)
         except AttributeError:
             print(f'{member} had no role to remove')
         except discord.Forbidden:
-            print(f"No permissions, to remove a role from {member}")
+            print(f"No permissions, to remove a role from {member}",
+                  level=WARNING)
 
     async def validate_key(self, member, response):
         """Shortcut for validating a key"""
-        if self.store.does_key_match(member, response):
+        if await self.store.does_key_match(member, response):
             return True
         return False
 
@@ -153,14 +246,14 @@ class Bot:
         Will also print the appropriate message
         """
         try:
-            user = self.store.get_user(member)
+            user = await self.store.get_user(member)
 
-            if user['approved']:
+            if user.approved:
                 print(f'{message.author} tried approved an '
                       + f'already approved member {member}')
 
                 await self.embed.nm_already_approved(
-                    message.author, member, user['key'])
+                    message.author, member, user.key)
                 return True
             return False
         except KeyError:
@@ -169,39 +262,25 @@ class Bot:
     async def get_user(self, name, channel=None):
         """Finds the user by its name
 
-        If no channel specified, iterates over all users, the bot can see
+        If no channel specified, looks in every server, the bot can see
         """
         if isinstance(name, (discord.User, discord.Member)):
             return name  # Don't do any lookup, if its already a member
 
-        if isinstance(channel, discord.Channel):  # Find in channel
-            member = discord.utils.find(
-                lambda m: str(m) == name, channel.server.members)
-            return member
-
-        # Else find from everyone the bot can see
-        for member in self.client.get_all_members():  # FIXME: Use discord.find
-            if str(member) == name:
-                return member
-
-        return None
+        return await self.get_user_by_id(self.member_ids.get(name), channel)
 
     async def get_user_by_id(self, user_id, channel=None):
         """Finds the user by its ID
 
-        If no channel specified, iterates over all users, the bot can see
+        If no channel specified, looks in every server, the bot can see
         """
-        if isinstance(channel, discord.Channel):  # Find in channel
-            member = discord.utils.find(
-                lambda m: m.id == user_id, channel.server.members)
-            return member
+        member = self.members.get(user_id)
 
-        # Else find from everyone the bot can see
-        for member in self.client.get_all_members():  # FIXME: Use discord.find
-            if member.id == user_id:
-                return member
+        if member and isinstance(channel, discord.Channel) \
+           and member.server.id != channel.server.id:
+            return None  # Not in the channel's server
 
-        return None
+        return member
 
     # FIXME: Too many returns
     async def add_user(self, message, approve):
@@ -230,34 +309,35 @@ class Bot:
 
             entry = await self.store.add_user(target, approve)
             await self.embed.nm_add(
-                message.author, '<unknown>', entry['key'], approve)
+                message.author, '<unknown>', entry.key, approve)
 
             return None
         # If the bot received !approve in a private message, channel won't
         # have a server, so look trough all the servers the bot is connected to
         elif isinstance(channel, discord.PrivateChannel):
-            # Iterates over all the channels the bot is connected to
-            for member in self.client.get_all_members():
-                if str(member) == target:
-                    if await self.is_user_approved(message, member):
-                        return  # Function will send a warning message
-
-                    if approve:
-                        await self.add_role(
-                            member, self.config.roles['approved']['ref'])
-
-                    # Send as a private message
-                    entry = await self.store.add_user(member, approve)
-                    await self.embed.nm_add(
-                        message.author, member, entry['key'], approve)
-
-                    return member
-            await print_error()
-            return None
+            # Looks in all the servers the bot is connected to
+            member = await self.get_user(target)
+
+            if not member:
+                await print_error()
+                return None
+
+            if await self.is_user_approved(message, member):
+                return  # Function will send a warning message
+
+            if approve:
+                await self.add_role(
+                    member, self.config.roles['approved']['ref'])
+
+            # Send as a private message
+            entry = await self.store.add_user(member, approve)
+            await self.embed.nm_add(
+                message.author, member, entry.key, approve)
+
+            return member
         elif isinstance(channel, discord.Channel):
-            # Only iterates over the message channel
-            member = discord.utils.find(
-                lambda m: str(m) == target, message.channel.server.members)
+            # Only looks in the message channel server
+            member = await self.get_user(target, channel)
 
             if not member:
                 await print_error()
@@ -268,10 +348,10 @@ class Bot:
 
             # Approval happens here
             entry = await self.store.add_user(member, approve)
-            key = entry['key']
+            key = entry.key
 
             # Send to the channel
-            print(f'{message.author} approved {target}, key - {key}')
+            print(f'{message.author} approved {target}')
             await self.embed.nm_add(message.author, member, key, approve)
             return member
         else:
@@ -286,7 +366,7 @@ class Bot:
         if is_id(target):
             try:
                 print(f'Removing user by ID - {target}')
-                name = self.store.get_user(target)['name']
+                name = (await self.store.get_user(target)).name
 
                 await self.store.remove_user_by_id(target)
                 await self.embed.nm_deleted(message.channel, name)
@@ -303,8 +383,8 @@ class Bot:
 
             try:
                 print("Falling back to DB lookup")
-                user_id = self.store.get_user_id(target)
-                name = self.store.get_user(user_id)['name']
+                user_id = await self.store.get_user_id(target)
+                name = (await self.store.get_user(user_id)).name
                 await self.store.remove_user_by_id(user_id)
                 await self.embed.nm_deleted(message.channel, name)
             except KeyError:
@@ -347,41 +427,194 @@ class Bot:
             return True
         return False
 
+    async def queue_request_key(self, member):
+        """Queues request_key() in the members pipeline lane
+
+        Returns false, if the member is already being validated
+        """
+        if self.currently_validating(member.id):
+            return False
+
+        await self.pipeline.submit(member.id, self.request_key, member)
+        return True
+
+    async def sweep_member(self, member):
+        """Handles a single member of the sweep, returns the action taken"""
+        if self.raid.holds(member.id):
+            return 'held for admission'
+
+        if await self.store.is_approved(member):
+            self.reconciled.add(member.id)
+            return 'approved'
+
+        # If the member has a pending key, ask to validate it instead
+        if await self.store.has_key(member):
+            print(f'{member} has a pending key, validating it instead')
+
+            if await self.queue_request_key(member):
+                return 'key requested'
+            return 'already validating'
+
+        print(f'Attempting to kick {member.name}')
+        await self.embed.nm_not_approved(member)
+
+        # NOTE: Removing a role + kicking
+        # == on_member_update infinite loop
+        if self.args.kick:
+            await self.kick(member)
+            return 'kicked'
+
+        await self.remove_role(member, self.config.roles['approved']['ref'])
+        self.reconciled.add(member.id)
+        return 'role removed'
+
     async def sweep_server(self):
         """Sweeps the server, when bot is ready
 
-        Meant to clean up users, that slipped in, while the bot was off
+        Meant to clean up users, that slipped in, while the bot was off.
+        Members are handled by --sweep-workers workers at once
         """
-        count = 0
+        started = time.monotonic()
+        counts = collections.Counter()
 
-        print('Performing a sweep, to kick unapproved users')
+        # Validations from before a restart, so they won't be DM'd again
+        await self.resume_pending()
 
         # list, so the generator wouldn't change, when someone is kicked
-        for member in list(self.config.server.members):
-            if not self.store.is_approved(member) and not member.bot:
-                # If the member has a pending key, ask to validate it instead
-                if self.store.get_user_key(member):
-                    print(f'{member} has a pending key, validating it instead')
-                    await self.request_key(member)
-                    return
+        everyone = [m for m in list(self.config.server.members) if not m.bot]
+        members = await self.changed_members(everyone)
+        pending = iter(members)
 
-                print(f'Attempting to kick {member.name}')
-                await self.embed.nm_not_approved(member)
-
-                # NOTE: Removing a role + kicking
-                # == on_member_update infinite loop
-                if self.args.kick:
-                    await self.kick(member)
-                else:
-                    await self.remove_role(
-                        member, self.config.roles['approved']['ref'])
+        # Unchanged since the snapshot, which only held reconciled ones
+        changed = {m.id for m in members}
+        self.reconciled.update(
+            m.id for m in everyone if m.id not in changed)
+
+        print(f'Performing a sweep of {len(members)} members, '
+              + f'with {self.args.sweep_workers} workers')
+
+        async def worker():
+            """Takes members off the shared iterator, until it runs out"""
+            for member in pending:
+                try:
+                    counts[await self.sweep_member(member)] += 1
+                except discord.HTTPException as error:
+                    print(f'Sweeping {member} failed - {error}',
+                          level=WARNING)
+                    counts['failed'] += 1
+
+                done = sum(counts.values())
+
+                if done % SWEEP_PROGRESS == 0:
+                    print(f'  Swept {done}/{len(members)} members')
+
+        await asyncio.gather(
+            *(worker() for _ in range(self.args.sweep_workers)))
+
+        summary = ', '.join(f'{i} - {counts[i]}' for i in sorted(counts))
+        duration = time.monotonic() - started
+        SWEEP_SECONDS.observe(duration)
+        print(f'Sweep complete in {duration:.1f}s, '
+              + (summary or 'no members'))
 
-                count += 1
+        self.swept = True
+        await self.store.run(save_state, SNAPSHOT_PATH, self.snapshot())
 
-        print(f'Sweep complete, {count} members removed')
         print('Also checking banned members')
         await self.sweep_bans()
 
+    def snapshot(self, unsettled=()):
+        """Compact state of the server, as the bot last reconciled it
+
+        Only reconciled members are listed. Those still held by raid
+        mode, queued in the pipeline or in unsettled are left out too,
+        so the next start sweeps them
+        """
+        skip = set(unsettled) | self.raid.queue.keys() \
+            | self.pipeline.lanes.keys()
+        members = [
+            m for m in self.config.server.members
+            if m.id in self.reconciled and m.id not in skip]
+
+        return {
+            'server': self.config.server.id,
+            'swept': time.time(),
+            'members': [m.id for m in members],
+            'approved': [m.id for m in members if self.has_approved_role(m)]
+        }
+
+    def save_snapshot(self, unsettled=()):
+        """Saves the snapshot for the next start, if there was a sweep
+
+        Blocks, only meant for the shutdown
+        """
+        if self.swept:
+            save_state(SNAPSHOT_PATH, self.snapshot(unsettled))
+
+    async def changed_members(self, members):
+        """Returns members, that joined or had their "Approved" role
+        change since the saved snapshot, or all of them without one
+
+        Members, that left in the meantime, get invalidated on the way,
+        like @on_member_remove would have
+        """
+        snapshot = await self.store.run(load_state, SNAPSHOT_PATH)
+
+        if self.args.full_sweep or not snapshot \
+           or snapshot['server'] != self.config.server.id:
+            return members  # Cold start, sweep everyone
+
+        known = set(snapshot['members'])
+        approved = set(snapshot['approved'])
+        left = known - {m.id for m in members}
+
+        for user_id in left:
+            if await self.store.is_approved(user_id) \
+               or await self.store.has_key(user_id):
+                await self.store.invalidate(user_id, True)  # Keep the key
+
+        changed = [
+            m for m in members if m.id not in known
+            or (m.id in approved) != bool(self.has_approved_role(m))]
+
+        age = time.time() - snapshot['swept']
+        print(f'Snapshot from {age:.0f}s ago, {len(changed)} members '
+              + f'joined or changed, {len(left)} left')
+
+        return changed
+
+    async def resume_pending(self):
+        """Resumes validations, journaled before a restart
+
+        Members, whose timeout ran out while the bot was off, are
+        declined together, the rest wait out what's left of theirs
+        """
+        expired = []
+        resumed = 0
+        now = time.time()
+
+        for user_id, deadline in self.router.journaled().items():
+            member = self.members.get(user_id)
+
+            if not member or await self.store.is_approved(member) \
+               or not await self.store.has_key(member):
+                self.router.forget(user_id)  # Left or settled meanwhile
+            elif deadline is not None and deadline <= now:
+                self.router.forget(user_id)
+                expired.append(member)
+            else:
+                key = await self.store.get_user_key(member)
+                self.await_response(member, self.router.resume(member, key))
+                resumed += 1
+
+        if resumed or expired:
+            print(f'Resumed {resumed} pending validations, '
+                  + f'{len(expired)} expired while offline')
+
+        for member in expired:
+            await self.pipeline.submit(
+                member.id, self.handle_response, member, None)
+
     async def sweep_bans(self):
         """Deletes members, with valid keys, from DB, if they're banned"""
         count = 0
@@ -395,79 +628,66 @@ class Bot:
                   + f"{self.config.server.name} ban list")
             return  # Return early
 
-        for member in bans:
-            if self.store.is_approved(member) and not member.bot:
+        # Only bans since the last sweep need handling
+        seen = set(await self.store.run(load_state, BANS_PATH, []))
+        new = [i for i in bans if i.id not in seen]
+        removed = []
+
+        print(f'{len(bans)} bans, {len(new)} new since the last sweep')
+
+        for member in new:
+            if await self.store.is_approved(member) and not member.bot:
                 print(f'Attempting to kick {member.name}')
                 await self.kick(member)
-                count += 1
+                removed.append(member.id)
 
-                success = await self.remove_user_silent(member)
+        # Banned members left the server and their roles with it,
+        # so they're only deleted from the DB, all in one transaction
+        if removed:
+            count = await self.store.remove_users_by_id(removed)
 
-                if success:
-                    print(f'Deleted {member} from the database')
+        # Unbanned IDs drop out, so a later ban is processed again
+        await self.store.run(save_state, BANS_PATH, [i.id for i in bans])
         print(f'Ban sweep complete, {count} members removed')
 
     async def request_key(self, member):
-        """Sends a message to a user, awaiting a key, else kick"""
+        """Sends a message to a user, requesting the key
+
+        Returns once it's sent, handle_response() takes the response
+        """
         timeout = None  # None means no timeout
 
         if self.args.timeout_time > 0:
             timeout = self.args.timeout_time
 
         try:
-            user = self.store.get_user(member)
+            user = await self.store.get_user(member)
 
-            if not user['valid']:
-                print(f'Updating an invalidated DB entry, ID - {member}')
-                self.store.update_user_entry(member)
+            if not user.valid:
+                print(f'Updating an invalidated DB entry, ID - {member}',
+                      level=DEBUG)
+                await self.store.update_user_entry(member)
 
-            if not user['approved']:
+            if not user.approved:
                 if self.currently_validating(member.id):
                     return  # @on_member_update can cause redundant calls
 
-                key = user['key']
-                # self.currently_validating[member.id] = True
-                self.pending_users.append(member.id)
+                key = user.key
+                response = self.router.add(member, key)  # Blocks repeats
 
                 # First arg referes to channel
-                await self.embed.nm_request_key(member, member)
-                print(f'Waiting for a key from {member}, ({key})')
-
-                response = await self.client.wait_for_message(
-                    timeout=timeout, author=member, content=key)
-
-                self.pending_users.remove(member.id)
-
-                if not response:
-                    print(f'Response from {member} was wrong')
-                    await self.embed.nm_decline_key(member)
-
-                    # Check if someone approved member, inbetween the request
-                    if not self.store.is_approved(member):
-                        await self.kick(member)
-                    return  # Return early
-
-                print(f'Received response: {response.content}')
-                status = await self.validate_key(member, response.content)
-
-                if status:
-                    print(f'{member} responded with a correct key')
-
-                    await self.embed.nm_accept_key(member, response.content)
-                    await self.store.add_user(member, True)  # Save approval
-
-                    # Assume the bot was intended to give the role and move
-                    await self.add_role(
-                        member, self.config.roles['approved']['ref'])
-
-                    await self.move(member, self.config.server.default_channel)
-                else:
-                    print(f'{member} response key was invalid')
-                    await self.embed.nm_decline_key(member)
-
-                    # Check if someone approved member, inbetween the request
-                    if not self.store.is_approved(member):
-                        await self.kick(member)
+                try:
+                    await self.embed.nm_request_key(member, member)
+                except discord.HTTPException:
+                    self.router.cancel(member.id)
+                    raise
+
+                # The timeout starts, once the DM is out of the queue
+                self.router.start(member.id, timeout)
+
+                print(f'Waiting for a key from {member}, ({key})',
+                      level=DEBUG)
+                self.await_response(member, response)
             else:
                 print(f'{member} member connecting to the server, '
                       + 'ensuring the user still has the "Approved" role')
@@ -482,6 +702,61 @@ class Bot:
             await self.embed.nm_unregistered_user(member)
             await self.kick(member)
 
+        self.reconciled.add(member.id)
+
+    def await_response(self, member, response):
+        """Queues handle_response() in the members pipeline lane, once
+        the response future resolves
+
+        The lane stays free in the meantime, so the members other
+        events, like leaving the server, aren't stuck behind the wait
+        """
+        def respond(future):
+            asyncio.ensure_future(self.pipeline.submit(
+                member.id, self.handle_response, member, future.result()))
+
+        response.add_done_callback(respond)
+
+    async def handle_response(self, member, response):
+        """Approves or kicks member, after its validation resolved"""
+        if response is CANCELLED:
+            self.waiters.resolve(member.id, 'cancelled')
+            return  # Called off, nothing left to do
+
+        if not response:
+            self.waiters.resolve(member.id, 'timed_out')
+            print(f'Response from {member} was wrong')
+            await self.embed.nm_decline_key(member)
+
+            # Check if someone approved member, inbetween the request
+            if not await self.store.is_approved(member):
+                await self.kick(member)
+            return  # Return early
+
+        print(f'Received response: {response.content}', level=DEBUG)
+        status = await self.validate_key(member, response.content)
+
+        if status:
+            print(f'{member} responded with a correct key')
+
+            await self.store.add_user(member, True)  # Save approval
+            self.waiters.resolve(member.id, 'approved')
+            await self.embed.nm_accept_key(member, response.content)
+
+            # Assume the bot was intended to give the role and move
+            await self.add_role(
+                member, self.config.roles['approved']['ref'])
+
+            await self.move(member, self.config.server.default_channel)
+        else:
+            print(f'{member} response key was invalid')
+            self.waiters.resolve(member.id, 'declined')
+            await self.embed.nm_decline_key(member)
+
+            # Check if someone approved member, inbetween the request
+            if not await self.store.is_approved(member):
+                await self.kick(member)
+
     def has_role(self, member, key):
         """Returns role, if member has it"""
         for role in member.roles:
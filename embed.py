@@ -25,7 +25,7 @@ import discord
 import icons
 import strings as st
 
-from utils import RED, YELLOW, GREEN, make_print
+from utils import RED, YELLOW, GREEN, DEBUG, make_print
 
 
 def print(*args, **kwargs):
@@ -42,9 +42,10 @@ def get_avatar(member):
 
 class Embed:
     """Methods for sending embed messages to client"""
-    def __init__(self, client, config, args):
+    def __init__(self, client, config, args, scheduler):
         """Instantiate"""
         self.client = client
+        self.scheduler = scheduler  # Every message goes out trough it
         self.config = config
         self.args = args
         self.timeout = ''
@@ -95,7 +96,7 @@ class Embed:
             icon_url=self.config.get_avatar()
         )
 
-        await self.client.send_message(channel, embed=embed)
+        await self.scheduler.send_message(channel, embed=embed)
 
     async def nm_unregistered_user(self, member):
         """Sends a message to member, pointing that it needs a key"""
@@ -106,7 +107,7 @@ class Embed:
         )
 
         embed.set_thumbnail(url=self.config.get_avatar())
-        await self.client.send_message(member, embed=embed)
+        await self.scheduler.send_message(member, embed=embed)
 
     async def nm_request_key(self, channel, member):
         """Sends 2 line message, asking for a member key"""
@@ -125,7 +126,7 @@ class Embed:
                         self.args.timeout_time)
                 )
 
-            await self.client.send_message(channel, embed=embed)
+            await self.scheduler.send_message(channel, embed=embed)
         except AttributeError:
             await self.sent_from_wrong_channel(channel)
 
@@ -158,7 +159,7 @@ class Embed:
             url=self.config.safe_get_user_avatar(member))
 
         embed.set_footer(text=st.MJ_WARNING)
-        await self.client.send_message(member, embed=embed)
+        await self.scheduler.send_message(member, embed=embed)
 
     async def nm_decline_key(self, member):
         """Sends a message, that the key was invalid"""
@@ -188,7 +189,7 @@ class Embed:
         embed.set_thumbnail(
             url=self.config.safe_get_user_avatar(member))
 
-        await self.client.send_message(member, embed=embed)
+        await self.scheduler.send_message(member, embed=embed)
 
     async def nm_approved(self, channel, member, status):
         """Sends the profile status of the member"""
@@ -237,8 +238,8 @@ class Embed:
         embed.set_thumbnail(url=get_avatar(member))
 
         # After embed is ready, send it to the channel
-        print(f'Sending am_approved embed to {member}')
-        await self.client.send_message(channel, embed=embed)
+        print(f'Sending am_approved embed to {member}', level=DEBUG)
+        await self.scheduler.send_message(channel, embed=embed)
 
     async def nm_does_not_exist(self, channel, who):
         """User does not exist message"""
@@ -311,7 +312,7 @@ class Embed:
         embed.set_thumbnail(
             url=self.config.safe_get_user_avatar(member))
 
-        await self.client.send_message(channel, embed=embed)
+        await self.scheduler.send_message(channel, embed=embed)
 
     async def nm_approve(self, channel, who, key):
         """Sends an added message, with the key"""
@@ -355,6 +356,44 @@ class Embed:
         await self.send_basic_template(
             message.channel, st.HEY.format(message.author.id), colour)
 
+    async def nm_reconciled(self, channel, result):
+        """Sends reconciliation counts"""
+        if not result:
+            await self.send_basic_template(channel, st.RECONCILING, YELLOW)
+            return
+
+        await self.send_basic_template(
+            channel,
+            st.RECONCILED.format(result['granted'], result['revoked']),
+            GREEN
+        )
+
+    async def nm_raid(self, channel, stats):
+        """Sends raid mode status"""
+        if stats['active']:
+            message, colour = st.RAID_ON, RED
+        else:
+            message, colour = st.RAID_OFF, GREEN
+
+        await self.send_basic_template(
+            channel, message.format(stats['queued']), colour)
+
+    async def nm_stats(self, channel, stats, top=10):
+        """Sends the slowest traced calls, by p99"""
+        if not stats:
+            await self.send_basic_template(channel, st.NO_STATS, YELLOW)
+            return
+
+        slowest = sorted(
+            stats.items(), key=lambda i: i[1]['p99_ms'], reverse=True)
+        lines = [
+            f'{name} - p50 {i["p50_ms"]}ms, p99 {i["p99_ms"]}ms, '
+            + f'{i["count"]} calls'
+            for name, i in slowest[:top]]
+
+        await self.send_basic_template(
+            channel, '```\n' + '\n'.join(lines) + '\n```', GREEN)
+
     async def send_basic_template(self, channel, message, colour=None):
         """Basic template for repetative messages"""
         if not colour:
@@ -366,4 +405,4 @@ class Embed:
             colour=colour
         )
 
-        await self.client.send_message(channel, embed=embed)
+        await self.scheduler.send_message(channel, embed=embed)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin
+import json
+import asyncio
+import itertools
+import collections
+
+from utils import make_print
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('Events', *args, **kwargs)
+
+
+BUFFER = 256  # Events held per subscriber, before the oldest are dropped
+MAX_SUBSCRIBERS = 100
+KEEPALIVE = 15  # Seconds of silence, before a comment keeps streams open
+
+
+class Subscriber:
+    """Bounded buffer of events, for a single client"""
+    def __init__(self, types=None):
+        self.types = types  # Set of event names, None for all of them
+        self.buffer = collections.deque(maxlen=BUFFER)
+        self.ready = asyncio.Event()
+        self.dropped = 0  # Since the client was last told
+
+    def push(self, event):
+        """Buffers event, a full buffer drops its oldest one"""
+        if self.types and event['type'] not in self.types:
+            return
+
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+
+        self.buffer.append(event)
+        self.ready.set()
+
+    async def take(self, timeout):
+        """Returns buffered events, waits up to timeout seconds for some
+
+        Lost events show up as a single "overflow" event, ahead of them
+        """
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+
+        self.ready.clear()
+        events = []
+
+        if self.dropped:
+            events.append({'type': 'overflow', 'dropped': self.dropped})
+            self.dropped = 0
+
+        events.extend(self.buffer)
+        self.buffer.clear()
+
+        return events
+
+
+class Broadcaster:
+    """Fans store changes out to subscribers, like the /events stream
+
+    publish() is a Store listener, so it runs on the store thread and
+    only hands the event over to the loop. A slow subscriber loses its
+    oldest events, it never grows
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.subscribers = set()
+        self.ids = itertools.count(1)
+
+    def publish(self, event, user_id, entry):
+        """Store listener, safe to call from any thread"""
+        self.loop.call_soon_threadsafe(self.dispatch, {
+            'type': event,
+            'user_id': user_id,
+            'user': entry.as_dict()
+        })
+
+    def dispatch(self, event):
+        """Hands the event to every subscriber, on the loop"""
+        event['event_id'] = next(self.ids)
+
+        for subscriber in self.subscribers:
+            subscriber.push(event)
+
+    def subscribe(self, types=None):
+        """Returns a new Subscriber, None if there are too many"""
+        if len(self.subscribers) >= MAX_SUBSCRIBERS:
+            return None
+
+        subscriber = Subscriber(types)
+        self.subscribers.add(subscriber)
+        print(f'Subscribed, {len(self.subscribers)} subscribers')
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Forgets subscriber"""
+        self.subscribers.discard(subscriber)
+        print(f'Unsubscribed, {len(self.subscribers)} subscribers')
+
+
+def format_sse(event):
+    """Returns event as a server-sent event"""
+    lines = f'event: {event["type"]}\n'
+
+    if 'event_id' in event:
+        lines += f'id: {event["event_id"]}\n'
+
+    return (lines + f'data: {json.dumps(event)}\n\n').encode()
@@ -25,3 +25,6 @@ APPROVE = "nm!approve"
 REMOVE = "nm!remove"
 AM = "nm!am"
 HEY = "nm!hey"
+RECONCILE = "nm!reconcile"
+RAID = "nm!raid"
+STATS = "nm!stats"
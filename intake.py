@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin
+import asyncio
+import collections
+import discord
+
+from utils import WARNING, make_print
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('Intake', *args, **kwargs)
+
+
+def changes(before, after):
+    """Returns a set of what changed between two states of a member,
+    that the bot cares about. Games and nicknames don't count
+    """
+    changed = set()
+
+    if before.status != after.status:
+        changed.add('status')
+    if str(before) != str(after):
+        changed.add('name')
+    if before.avatar != after.avatar:
+        changed.add('avatar')
+    if {i.id for i in before.roles} != {i.id for i in after.roles}:
+        changed.add('roles')
+    if before.server.id != after.server.id:
+        changed.add('server')
+
+    return changed
+
+
+class Intake:
+    """Filters and coalesces @on_member_update events
+
+    Presence noise of members, the DB already knows right, is dropped.
+    Status changes count as noise too, once the member is approved and
+    holds the "Approved" role. Events of the same member, within the
+    debounce window, are merged into one, from the first before to the
+    last after
+    """
+    def __init__(self, store, args, bot):
+        self.loop = asyncio.get_event_loop()
+        self.store = store
+        self.bot = bot
+        self.window = args.debounce_window
+        self.handler = None
+        # Member ID -> [first before, last after, flush timer]
+        self.pending = {}
+        self.counts = collections.Counter()
+
+    def listen(self, handler):
+        """Sets the coroutine, that processes the updates, that remain"""
+        self.handler = handler
+
+    def stats(self):
+        """Event counts, for the API"""
+        return {
+            'window': self.window,
+            'pending': len(self.pending),
+            **{i: self.counts[i] for i in (
+                'received', 'dropped', 'coalesced', 'processed',
+                'discarded')}
+        }
+
+    def discard(self, user_id):
+        """Drops the held update of a member, that left or got banned,
+        so it isn't processed after the removal
+        """
+        held = self.pending.pop(user_id, None)
+
+        if held:
+            held[2].cancel()
+            self.counts['discarded'] += 1
+
+    async def is_noise(self, before, after):
+        """Returns true, if the update needs no action"""
+        changed = changes(before, after)
+
+        # Status changes only matter to members, that may need validating
+        if changed == {'status'} and await self.store.is_approved(after) \
+           and self.bot.has_approved_role(after):
+            changed = set()
+
+        if changed:
+            return False
+
+        # Unknown or stale entries still need updating
+        return await self.store.has_entry(after.id) \
+            and await self.store.is_valid(after) \
+            and not await self.store.is_new_name(after.id, str(after))
+
+    async def submit(self, before, after):
+        """Takes in an update, processing happens after the window"""
+        self.counts['received'] += 1
+        held = self.pending.get(after.id)
+
+        if held:
+            held[1] = after  # Only the last state matters
+            self.counts['coalesced'] += 1
+            return
+
+        if await self.is_noise(before, after):
+            self.counts['dropped'] += 1
+            return
+
+        if not self.window:
+            await self.process(before, after)
+            return
+
+        # Window starts at the first event, so a chatty member
+        # still gets processed every window
+        self.pending[after.id] = [
+            before, after,
+            self.loop.call_later(self.window, self.flush, after.id)]
+
+    def flush(self, user_id):
+        """Processes the coalesced update of user_id"""
+        before, after, _ = self.pending.pop(user_id)
+        asyncio.ensure_future(self.settle(before, after))
+
+    async def settle(self, before, after):
+        """Processes a coalesced update, unless it netted out to noise"""
+        if await self.is_noise(before, after):
+            self.counts['dropped'] += 1
+            return
+
+        await self.process(before, after)
+
+    async def process(self, before, after):
+        """Hands the update to the handler"""
+        self.counts['processed'] += 1
+
+        try:
+            await self.handler(before, after)
+        except discord.HTTPException as error:
+            print(f'Processing an update of {after} failed - {error}',
+                  level=WARNING)
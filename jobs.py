@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin, broad-except, too-many-instance-attributes
+import time
+import uuid
+import asyncio
+import itertools
+import collections
+
+from utils import WARNING, make_print
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('Jobs', *args, **kwargs)
+
+
+WORKERS = 4  # Jobs running at once
+KEEP = 1000  # Finished jobs kept around for /jobs/{id}
+LIMIT = 1000  # Queued jobs, before routes answer 503
+
+
+class Job:
+    """Background follow-up of an API request"""
+    __slots__ = ('id', 'kind', 'target', 'state', 'created', 'finished',
+                 'result', 'error', 'call', 'args')
+
+    def __init__(self, kind, target, call, args):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.target = target
+        self.state = 'queued'  # queued > running > done / failed
+        self.created = time.time()
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.call = call
+        self.args = args
+
+    def as_dict(self):
+        """Returns the job status, for the API"""
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'target': self.target,
+            'state': self.state,
+            'created': self.created,
+            'finished': self.finished,
+            'result': self.result,
+            'error': self.error
+        }
+
+
+class JobManager:
+    """Runs API follow-ups on a bounded pool of workers
+
+    Routes queue a job and answer right away, with its ID. Its state
+    can be polled, until the last KEEP jobs push it out. Routes check
+    full() first, so at most LIMIT jobs wait
+    """
+    def __init__(self, workers=WORKERS, keep=KEEP, limit=LIMIT):
+        self.workers = workers
+        self.keep = keep
+        self.limit = limit
+        self.jobs = collections.OrderedDict()  # ID -> Job, oldest first
+        self.queue = asyncio.Queue()
+        self.tasks = []
+
+    def start(self):
+        """Starts the workers"""
+        if not self.tasks:
+            self.tasks = [asyncio.ensure_future(self.run())
+                          for _ in range(self.workers)]
+
+    def full(self):
+        """Returns true, if there are limit jobs waiting already"""
+        return self.queue.qsize() >= self.limit
+
+    def submit(self, kind, target, call, *args):
+        """Queues call(*args), returns the Job"""
+        job = Job(kind, target, call, args)
+        self.jobs[job.id] = job
+        self.queue.put_nowait(job)
+
+        # Forget the oldest finished jobs, unfinished ones always stay
+        excess = len(self.jobs) - self.keep
+
+        if excess > 0:
+            finished = list(itertools.islice((
+                i for i, j in self.jobs.items() if j.finished is not None),
+                excess))
+
+            for job_id in finished:
+                del self.jobs[job_id]
+
+        return job
+
+    def get(self, job_id):
+        """Returns the job under job_id, None if there's none"""
+        return self.jobs.get(job_id)
+
+    async def run(self):
+        """Worker, runs queued jobs"""
+        while True:
+            job = await self.queue.get()
+            job.state = 'running'
+
+            try:
+                job.result = await job.call(*job.args)
+                job.state = 'done'
+            except Exception as error:
+                print(f'{job.kind} job for {job.target} failed - {error}',
+                      level=WARNING)
+                job.error = str(error)
+                job.state = 'failed'
+            finally:
+                job.finished = time.time()
+                job.call = job.args = None  # Let go of members
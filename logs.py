@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import sys
+import json
+import atexit
+import queue
+import logging
+import logging.handlers
+
+LOGGER = 'norman'  # Every module logs under norman.<print prefix>
+LEVELS = ('debug', 'info', 'warning', 'error')
+
+
+class PlainFormatter(logging.Formatter):
+    """Prefix: message, same as the prints used to look"""
+    def format(self, record):
+        prefix = record.name.rsplit('.', 1)[-1]
+        line = f'{prefix}: {record.getMessage()}'
+
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log collectors"""
+    def format(self, record):
+        line = {
+            'time': record.created,
+            'level': record.levelname.lower(),
+            'logger': record.name.rsplit('.', 1)[-1],
+            'message': record.getMessage()
+        }
+
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(line)
+
+
+# Records are queued on the calling thread and written by the listener's
+# own thread, a slow stdout never blocks the event loop
+HANDLER = logging.StreamHandler(sys.stdout)
+HANDLER.setFormatter(PlainFormatter())
+LISTENER = logging.handlers.QueueListener(queue.Queue(), HANDLER)
+
+
+def start_logging():
+    """Routes the norman loggers trough the queue, at info level"""
+    root = logging.getLogger(LOGGER)
+    root.setLevel(logging.INFO)
+    root.propagate = False
+    root.addHandler(logging.handlers.QueueHandler(LISTENER.queue))
+    LISTENER.start()
+    atexit.register(stop_logging)
+
+
+def configure_logging(level, json_output=False):
+    """Applies --log-level and --log-json"""
+    logging.getLogger(LOGGER).setLevel(level.upper())
+
+    if json_output:
+        HANDLER.setFormatter(JsonFormatter())
+
+
+def stop_logging():
+    """Writes out whatever is still queued, runs at exit"""
+    LISTENER.stop()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin
+import time
+import bisect
+import asyncio
+import functools
+
+from utils import make_print
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('Metrics', *args, **kwargs)
+
+
+# Upper bounds of histogram buckets, in seconds
+BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+LAG_INTERVAL = 1.0  # Seconds between event loop lag samples
+
+
+def format_labels(names, values, extra=''):
+    """Returns {name="value", …}, escaped like Prometheus expects"""
+    pairs = [
+        f'{name}="' + str(value).replace('\\', r'\\').replace(
+            '"', r'\"').replace('\n', r'\n') + '"'
+        for name, value in zip(names, values)]
+
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonic count, per label values
+
+    inc() is a dict lookup and an add, cheap enough for hot paths
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # Label values -> count
+
+    def inc(self, *labels, amount=1):
+        """Adds amount to the count of labels"""
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        """Yields exposition lines"""
+        for labels, value in self.values.items():
+            yield f'{self.name}{format_labels(self.labels, labels)} {value}'
+
+
+class Gauge:
+    """Value, read from a callback at the time of the scrape"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        """Yields exposition lines"""
+        yield f'{self.name} {self.read()}'
+
+
+class Histogram:
+    """Distribution of observed values, per label values"""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # Label values -> [bucket counts, sum, count]
+
+    def observe(self, value, *labels):
+        """Counts value into its bucket"""
+        held = self.values.get(labels)
+
+        if held is None:
+            held = self.values[labels] = [[0] * len(self.buckets), 0, 0]
+
+        index = bisect.bisect_left(self.buckets, value)
+
+        if index < len(self.buckets):
+            held[0][index] += 1
+
+        held[1] += value
+        held[2] += 1
+
+    def samples(self):
+        """Yields exposition lines, buckets are cumulative"""
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield (f'{self.name}_bucket'
+                       + format_labels(self.labels, labels, f'le="{bound}"')
+                       + f' {cumulative}')
+
+            yield (f'{self.name}_bucket'
+                   + format_labels(self.labels, labels, 'le="+Inf"')
+                   + f' {count}')
+            yield f'{self.name}_sum{format_labels(self.labels, labels)} ' \
+                + str(total)
+            yield f'{self.name}_count{format_labels(self.labels, labels)} ' \
+                + str(count)
+
+
+class Registry:
+    """Holds every metric, renders them for /metrics"""
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        """Registers metric, returns it"""
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        """Registers a Counter"""
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, read):
+        """Registers a Gauge"""
+        return self.add(Gauge(name, help, read))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        """Registers a Histogram"""
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        lines = []
+
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+EVENTS = REGISTRY.counter(
+    'norman_gateway_events_total', 'Gateway events handled', ('event',))
+STORE_SECONDS = REGISTRY.histogram(
+    'norman_store_seconds', 'Store calls on the store thread, queue '
+    + 'included', ('operation',))
+DISCORD_CALLS = REGISTRY.counter(
+    'norman_discord_calls_total', 'Outbound Discord calls, by outcome',
+    ('route', 'outcome'))
+SWEEP_SECONDS = REGISTRY.histogram(
+    'norman_sweep_seconds', 'Duration of server sweeps',
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800))
+API_SECONDS = REGISTRY.histogram(
+    'norman_api_request_seconds', 'API request latency',
+    ('route', 'method', 'status'))
+LOOP_LAG = REGISTRY.histogram(
+    'norman_loop_lag_seconds', 'How late the event loop wakes up')
+
+
+def handled(handler):
+    """Decorates a client event handler, counting its events"""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        EVENTS.inc(name)
+        return await handler(*args, **kwargs)
+    return wrapper
+
+
+async def watch_loop_lag():
+    """Samples how much later, than asked, the loop wakes up"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(LAG_INTERVAL)
+        LOOP_LAG.observe(
+            max(time.monotonic() - started - LAG_INTERVAL, 0))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin, broad-except
+import asyncio
+import collections
+
+from utils import WARNING, make_print
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('Pipeline', *args, **kwargs)
+
+
+class Pipeline:
+    """Keyed work queue, for member events
+
+    Jobs of the same key run one after another, in the order they were
+    submitted. Different keys run in parallel, on a fixed pool of
+    workers. Only keys with work waiting sit in the ready queue, so a
+    busy member never holds up a worker, while another is waiting
+    """
+    def __init__(self, args):
+        self.workers = args.pipeline_workers
+        self.limit = args.pipeline_limit
+        self.lanes = {}  # Key -> deque of (call, args), head is running
+        self.ready = asyncio.Queue()  # Keys, whose next job can run
+        self.slots = asyncio.Semaphore(self.limit)  # Backpressure
+        self.depth = 0  # Jobs submitted, but not finished
+        self.max_depth = 0
+        self.busy = 0
+        self.tasks = []
+        self.counts = collections.Counter()
+
+    def start(self):
+        """Starts the workers"""
+        if not self.tasks:
+            self.tasks = [asyncio.ensure_future(self.run())
+                          for _ in range(self.workers)]
+
+    def stats(self):
+        """Returns queue depths and counters"""
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'limit': self.limit,
+            'lanes': len(self.lanes),
+            'ready': self.ready.qsize(),
+            'busy': self.busy,
+            'workers': self.workers,
+            'counts': dict(self.counts)
+        }
+
+    async def submit(self, key, call, *args):
+        """Queues call(*args) behind earlier jobs of key
+
+        Waits, while --pipeline-limit jobs are already queued. Never
+        await this from inside a job, it could wait on itself
+        """
+        await self.slots.acquire()
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self.counts['submitted'] += 1
+
+        lane = self.lanes.get(key)
+
+        if lane is None:
+            lane = self.lanes[key] = collections.deque()
+            self.ready.put_nowait(key)
+
+        lane.append((call, args))
+
+    async def run(self):
+        """Worker, runs the next job of whichever key is ready"""
+        while True:
+            key = await self.ready.get()
+            lane = self.lanes[key]
+            call, args = lane[0]
+            self.busy += 1
+
+            try:
+                await call(*args)
+                self.counts['processed'] += 1
+            except Exception:
+                print(f'Job of {key} failed', level=WARNING, exc_info=True)
+                self.counts['failed'] += 1
+            finally:
+                self.busy -= 1
+                self.depth -= 1
+                self.slots.release()
+                lane.popleft()
+
+                # Back of the line, so other keys get their turn
+                if lane:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.lanes[key]
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin, too-many-instance-attributes
+import time
+import asyncio
+import collections
+
+from utils import WARNING, make_print
+from scheduler import TokenBucket
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('Raid', *args, **kwargs)
+
+
+class RaidGuard:
+    """Holds joining members back, while the server is being raided
+
+    Raid mode engages, once --raid-joins members join within
+    --raid-window seconds, or when an admin turns it on. Joins then go
+    into an admission queue, instead of straight to validation.
+    Members, the DB knows nothing about, are kicked in batches, without
+    any DMs. The rest are let trough, --raid-rate members a second
+    """
+    def __init__(self, bot, store, args):
+        self.bot = bot
+        self.store = store
+        self.args = args
+        self.active = False
+        self.manual = False  # Turned on by an admin, stays until off
+        self.joins = collections.deque()  # Recent join times
+        self.queue = collections.OrderedDict()  # ID -> member
+        self.bucket = TokenBucket(args.raid_rate, 1.0)
+        self.wakeup = asyncio.Event()
+        self.worker = None
+        self.counts = collections.Counter()
+
+    def start(self):
+        """Starts working trough the admission queue"""
+        if not self.worker:
+            self.worker = asyncio.ensure_future(self.run())
+
+    def stats(self):
+        """Returns the mode, queue depth and counters"""
+        self.trim()
+
+        return {
+            'active': self.active,
+            'manual': self.manual,
+            'joins': len(self.joins),
+            'queued': len(self.queue),
+            'counts': dict(self.counts)
+        }
+
+    def holds(self, user_id):
+        """Returns true, if the member still waits for admission"""
+        return user_id in self.queue
+
+    def discard(self, user_id):
+        """Drops a member, that left, from the queue"""
+        self.queue.pop(user_id, None)
+
+    def engage(self, manual=False):
+        """Turns raid mode on"""
+        self.manual = self.manual or manual
+
+        if not self.active:
+            self.active = True
+            self.counts['engaged'] += 1
+            print(f'Raid mode on, {len(self.joins)} joins '
+                  + f'in {self.args.raid_window}s')
+
+    def disengage(self):
+        """Turns raid mode off, queued members are still admitted"""
+        if self.active:
+            print(f'Raid mode off, {len(self.queue)} members still queued')
+
+        self.active = False
+        self.manual = False
+
+    def trim(self):
+        """Forgets joins, older than the window"""
+        now = time.monotonic()
+
+        while self.joins and now - self.joins[0] > self.args.raid_window:
+            self.joins.popleft()
+
+    def admit(self, member):
+        """Records a join, returns true, if the member got queued"""
+        self.joins.append(time.monotonic())
+        self.trim()
+
+        if len(self.joins) >= self.args.raid_joins:
+            self.engage()
+
+        if not self.active:
+            return False
+
+        self.queue[member.id] = member
+        self.counts['queued'] += 1
+        self.wakeup.set()
+
+        return True
+
+    def kick(self, member):
+        """Starts kicking member, failures are only logged"""
+        def kicked(future):
+            if not future.cancelled() and future.exception():
+                print(f'Kicking {member} failed - {future.exception()}',
+                      level=WARNING)
+
+        asyncio.ensure_future(self.bot.kick(member)).add_done_callback(kicked)
+
+    async def run(self):
+        """Worker, admits queued members, while checking the join rate"""
+        while True:
+            wait = await self.process()
+            self.wakeup.clear()
+
+            try:  # Returns early, if someone joins
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+            # Auto mode ends, once joins calm down to half the trigger
+            self.trim()
+
+            if self.active and not self.manual \
+               and len(self.joins) < self.args.raid_joins / 2:
+                self.disengage()
+
+    async def process(self):
+        """Kicks unknown members, then admits whoever the rate allows
+
+        Returns seconds until the next member could be admitted
+        """
+        unknown = []
+
+        for user_id, member in list(self.queue.items()):
+            if not await self.store.is_approved(member) \
+               and not await self.store.has_key(member):
+                unknown.append(self.queue.pop(user_id))
+
+        if unknown:
+            # Kicks trickle out at the scheduler's rate, admissions and
+            # the raid checks don't wait for them
+            print(f'Kicking {len(unknown)} unknown members')
+            self.counts['kicked'] += len(unknown)
+
+            for member in unknown:
+                self.kick(member)
+
+        while self.queue:
+            wait = self.bucket.take()
+
+            if wait:
+                return wait
+
+            _, member = self.queue.popitem(last=False)
+            self.counts['admitted'] += 1
+            await self.bot.queue_request_key(member)
+
+        return 1.0
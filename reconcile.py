@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin
+import asyncio
+
+from utils import WARNING, make_print
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('Reconciler', *args, **kwargs)
+
+
+class Reconciler:
+    """Brings the "Approved" role in line with the DB
+
+    The whole server is diffed in one pass, against the approved IDs
+    of the store's in-memory index. Only the differences turn into
+    role changes, which go out together, trough the bot
+    """
+    def __init__(self, bot, store, config, args):
+        self.bot = bot
+        self.store = store
+        self.config = config
+        self.args = args
+        self.running = False
+
+    async def plan(self):
+        """Returns (grant, revoke) lists of members
+
+        grant - approved in the DB, but missing the role
+        revoke - holding the role, without being approved
+        """
+        role = self.config.roles['approved']['ref']
+
+        if not role or not self.config.server:
+            return [], []  # Nothing to reconcile against
+
+        members = {
+            m.id: m for m in list(self.config.server.members) if not m.bot}
+        has_role = {
+            i for i, m in members.items()
+            if any(r.id == role.id for r in m.roles)}
+        approved = await self.store.approved_ids()
+
+        grant = [members[i] for i in approved & members.keys() - has_role]
+        revoke = [
+            members[i] for i in has_role - approved
+            if not self.bot.currently_validating(i)]
+
+        return grant, revoke
+
+    async def reconcile(self, budget=None):
+        """Runs the plan, at most budget role changes of it
+
+        Returns counts of what was done and what was left for later
+        """
+        if self.running:
+            return None  # One pass at a time
+
+        self.running = True
+
+        try:
+            grant, revoke = await self.plan()
+            role = self.config.roles['approved']['ref']
+            actions = [(self.bot.add_role, m) for m in grant] \
+                + [(self.bot.remove_role, m) for m in revoke]
+            deferred = 0
+
+            if budget is not None and len(actions) > budget:
+                deferred = len(actions) - budget
+                actions = actions[:budget]  # Grants go first
+
+            results = await asyncio.gather(
+                *(call(member, role) for call, member in actions),
+                return_exceptions=True)
+            failed = 0
+
+            for (_, member), result in zip(actions, results):
+                if isinstance(result, Exception):
+                    print(f'Reconciling {member} failed - {result}',
+                          level=WARNING)
+                    failed += 1
+
+            granted = min(len(grant), len(actions))
+
+            if actions:
+                print(f'Reconciled {len(actions)} members, '
+                      + f'{deferred} deferred, {failed} failed')
+
+            return {
+                'granted': granted,
+                'revoked': len(actions) - granted,
+                'deferred': deferred,
+                'failed': failed
+            }
+        finally:
+            self.running = False
+
+    def start(self):
+        """Starts the periodic reconciliation, unless it's turned off"""
+        if self.args.reconcile_interval > 0:
+            asyncio.ensure_future(self.run())
+
+    async def run(self):
+        """Reconciles every --reconcile-interval seconds, within
+        --reconcile-budget role changes. Waits for the first sweep
+        """
+        while True:
+            await asyncio.sleep(self.args.reconcile_interval)
+
+            if not self.bot.swept:
+                continue
+
+            try:
+                await self.reconcile(self.args.reconcile_budget)
+            except Exception:  # pylint: disable=broad-except
+                # Keep the loop alive, the next run will try again
+                print('Reconciliation failed', level=WARNING, exc_info=True)
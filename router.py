@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin
+import time
+import heapq
+import shelve
+import asyncio
+
+from utils import make_print
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('Router', *args, **kwargs)
+
+
+# Result of a validation, that was called off, before it could finish
+CANCELLED = object()
+
+
+class Validation:
+    """Pending key validation of a single member"""
+    __slots__ = ('member', 'key', 'deadline', 'future')
+
+    def __init__(self, member, key, deadline):
+        self.member = member
+        self.key = key
+        self.deadline = deadline  # Loop time, None means no timeout
+        self.future = asyncio.get_event_loop().create_future()
+
+
+class DmRouter:
+    """Routes incoming messages to pending key validations
+
+    Validations are looked up by author ID, so every message costs the
+    same, no matter how many members are validating. Deadlines sit in a
+    heap, served by a single timer, armed for the earliest one.
+
+    With a path, pending validations are also journaled there, with
+    their wall clock deadlines, so they survive restarts. The journal is
+    read from a copy in memory and written trough run(call, *args), off
+    the loop, like AsyncStore.run
+    """
+    def __init__(self, path=None, run=None):
+        self.loop = asyncio.get_event_loop()
+        self.shelf = shelve.open(str(path)) if path else None
+        self.journal = dict(self.shelf) if path else {}  # ID -> deadline
+        self.run = run
+        self.pending = {}  # Member ID -> Validation
+        self.deadlines = []  # Heap of (deadline, member ID)
+        self.timer = None
+        self.timer_at = None
+
+    def __contains__(self, user_id):
+        # Journaled ones count too, until they're resumed or forgotten
+        return user_id in self.pending or user_id in self.journal
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, member, key):
+        """Registers a validation, returns a future of its result
+
+        The future resolves with the message, that contained the key,
+        None once the timeout given to start() runs out or CANCELLED.
+        Until start(), there's no timeout and nothing is journaled
+        """
+        return self.register(member, key)
+
+    def start(self, user_id, timeout=None):
+        """Starts the timeout of a validation and journals it
+
+        Called once the key request is actually sent, which can take a
+        while, when DMs queue up
+        """
+        if user_id not in self.pending:
+            return  # Resolved, while the key request was going out
+
+        # Journal holds wall clock time, loop time doesn't survive restarts
+        deadline = time.time() + timeout if timeout else None
+        self.journal[user_id] = deadline
+        self.write(self.save_deadline, user_id, deadline)
+        self.expire_in(user_id, timeout)
+
+    def resume(self, member, key):
+        """Registers a journaled validation again, with whatever is left
+        of its timeout. Returns a future, like add()
+        """
+        deadline = self.journal[member.id]
+        future = self.register(member, key)
+
+        if deadline is not None:
+            self.expire_in(member.id, max(deadline - time.time(), 0))
+
+        return future
+
+    def register(self, member, key):
+        """Holds the validation in memory, without a deadline"""
+        validation = Validation(member, key, None)
+        self.pending[member.id] = validation
+
+        return validation.future
+
+    def expire_in(self, user_id, timeout):
+        """Gives the validation a deadline and arms the timer for it"""
+        if timeout is None:
+            return
+
+        deadline = self.loop.time() + timeout
+        self.pending[user_id].deadline = deadline
+        heapq.heappush(self.deadlines, (deadline, user_id))
+        self.arm()
+
+    def journaled(self):
+        """Returns {member ID: wall clock deadline} of journaled
+        validations, that aren't pending in memory, like after a restart
+        """
+        return {i: self.journal[i] for i in list(self.journal.keys())
+                if i not in self.pending}
+
+    def forget(self, user_id):
+        """Drops a journaled validation, that won't be resumed"""
+        if user_id in self.journal:
+            del self.journal[user_id]
+            self.write(self.drop_deadline, user_id)
+
+    def write(self, call, *args):
+        """Runs a journal write trough run(), if there's a journal file"""
+        if self.shelf is None:
+            return
+
+        if self.run:
+            self.run(call, *args)
+        else:
+            call(*args)
+
+    def save_deadline(self, user_id, deadline):
+        """Writes the deadline of user_id to the journal file"""
+        self.shelf[user_id] = deadline
+
+    def drop_deadline(self, user_id):
+        """Removes user_id from the journal file"""
+        self.shelf.pop(user_id, None)
+
+    def close(self):
+        """Closes the journal, pending validations stay in it
+
+        Writes queued trough run() have to be done by now
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+
+        if self.shelf is not None:
+            self.shelf.close()
+
+    def route(self, message):
+        """Resolves the validation of message.author, if message holds its
+        key. Returns true, if it did
+        """
+        validation = self.pending.get(message.author.id)
+
+        if validation is None or message.content != validation.key:
+            return False
+
+        self.resolve(message.author.id, message)
+        return True
+
+    def cancel(self, user_id):
+        """Calls off the validation of user_id, if there is one"""
+        if user_id in self.pending:
+            print(f'Cancelling the validation of {user_id}')
+            self.resolve(user_id, CANCELLED)
+        else:
+            self.forget(user_id)
+
+    def resolve(self, user_id, result):
+        """Removes the validation and sets its result"""
+        validation = self.pending.pop(user_id)
+        self.forget(user_id)
+
+        if not validation.future.done():
+            validation.future.set_result(result)
+
+    def arm(self):
+        """Points the timer at the earliest deadline"""
+        if not self.deadlines:
+            return
+
+        deadline = self.deadlines[0][0]
+
+        if self.timer is not None:
+            if self.timer_at <= deadline:
+                return  # Already fires early enough
+            self.timer.cancel()
+
+        self.timer = self.loop.call_at(deadline, self.expire)
+        self.timer_at = deadline
+
+    def expire(self):
+        """Times out every validation past its deadline"""
+        self.timer = None
+        now = self.loop.time()
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, user_id = heapq.heappop(self.deadlines)
+            validation = self.pending.get(user_id)
+
+            # Resolved validations leave their deadlines behind
+            if validation is not None and validation.deadline == deadline:
+                self.resolve(user_id, None)
+
+        self.arm()
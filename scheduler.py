@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin, import-error, too-many-instance-attributes
+import time
+import asyncio
+import collections
+import discord
+
+from utils import WARNING, make_print
+from metrics import DISCORD_CALLS
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('Scheduler', *args, **kwargs)
+
+
+# Outbound routes, in the order of their priority, with their token
+# bucket size and the seconds it takes to refill it
+ROUTES = collections.OrderedDict([
+    ('roles', (10, 10.0)),
+    ('kick', (5, 5.0)),
+    ('message', (5, 5.0)),
+    ('dm', (5, 5.0))
+])
+
+MAX_RETRIES = 5
+BACKOFF = 1.0  # Seconds before the first retry, doubles after each
+THROUGHPUT_WINDOW = 60.0  # Seconds of sent actions, that count as throughput
+
+
+class TokenBucket:
+    """Allows size actions every per seconds, refilling continuously"""
+    def __init__(self, size, per):
+        self.size = size
+        self.tokens = size
+        self.rate = size / per
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Takes a token, returns 0 if it was there, else seconds to wait"""
+        now = time.monotonic()
+        self.tokens = min(
+            self.size, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Action:
+    """Queued outbound call"""
+    __slots__ = ('route', 'call', 'args', 'kwargs', 'future', 'key',
+                 'attempts', 'cancelled')
+
+    def __init__(self, route, call, args, kwargs, key):
+        self.route = route
+        self.call = call
+        self.args = args
+        self.kwargs = kwargs
+        self.future = asyncio.get_event_loop().create_future()
+        self.key = key  # Coalescing key, None if it can't be coalesced
+        self.attempts = 0
+        self.cancelled = False
+
+
+class Scheduler:
+    """Sends outbound Discord calls trough per-route token buckets
+
+    Role changes go out first, then kicks, then messages. Calls, that
+    hit 429 or 5xx get retried with a backoff. Queued role changes and
+    kicks of the same member are coalesced, only the last role change
+    of a member and role goes out
+    """
+    def __init__(self, client, concurrency=4):
+        self.client = client
+        self.queues = collections.OrderedDict(
+            (route, collections.deque()) for route in ROUTES)
+        self.buckets = {
+            route: TokenBucket(*ROUTES[route]) for route in ROUTES}
+
+        self.queued = {}  # Coalescing key -> queued action
+        self.wakeup = asyncio.Event()
+        self.in_flight = asyncio.Semaphore(concurrency)
+        self.running = 0
+        self.worker = None
+
+        self.counts = collections.Counter()
+        self.sent = collections.deque()  # Timestamps of sent actions
+
+    def start(self):
+        """Starts taking actions off the queues"""
+        if not self.worker:
+            self.worker = asyncio.ensure_future(self.run())
+
+    def stats(self):
+        """Returns queue depths and counters"""
+        now = time.monotonic()
+
+        while self.sent and now - self.sent[0] > THROUGHPUT_WINDOW:
+            self.sent.popleft()
+
+        return {
+            'queued': {route: len(self.queues[route]) for route in ROUTES},
+            'in_flight': self.running,
+            'throughput': len(self.sent) / THROUGHPUT_WINDOW,
+            'counts': dict(self.counts)
+        }
+
+    def submit(self, route, call, *args, key=None, **kwargs):
+        """Queues call(*args, **kwargs), returns a future of its result"""
+        action = Action(route, call, args, kwargs, key)
+
+        if key is not None:
+            queued = self.queued.get(key)
+
+            if queued is not None and not queued.cancelled:
+                # Superseded, the last queued change is the one that counts
+                queued.cancelled = True
+                queued.future.set_result(None)
+                self.counts['coalesced'] += 1
+
+            self.queued[key] = action
+
+        self.queues[route].append(action)
+        self.counts['queued'] += 1
+        self.wakeup.set()
+
+        return action.future
+
+    def next_action(self):
+        """Returns the next action, that has a token, and None
+
+        If there's none, returns None and the seconds until a token is
+        available, or None if all the queues are empty
+        """
+        wait = None
+
+        for route, queue in self.queues.items():
+            while queue and queue[0].cancelled:
+                queue.popleft()
+
+            if not queue:
+                continue
+
+            delay = self.buckets[route].take()
+
+            if delay == 0:
+                action = queue.popleft()
+
+                if self.queued.get(action.key) is action:
+                    del self.queued[action.key]
+                return action, None
+
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def run(self):
+        """Worker, starts actions as their tokens become available"""
+        while True:
+            action, wait = self.next_action()
+
+            if action is None:
+                self.wakeup.clear()
+
+                try:  # Returns early, if something new is queued
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self.in_flight.acquire()
+            self.running += 1
+            asyncio.ensure_future(self.execute(action))
+
+    async def execute(self, action):
+        """Runs the action, retries it on 429 and 5xx"""
+        try:
+            result = await action.call(*action.args, **action.kwargs)
+        except discord.HTTPException as error:
+            status = getattr(error.response, 'status', 0)
+            DISCORD_CALLS.inc(action.route, str(status))
+
+            if (status == 429 or status >= 500) \
+               and action.attempts < MAX_RETRIES:
+                delay = BACKOFF * 2 ** action.attempts
+                action.attempts += 1
+                self.counts['retried'] += 1
+
+                print(f'{action.route} call failed with {status}, '
+                      + f'retrying in {delay}s', level=WARNING)
+                asyncio.get_event_loop().call_later(
+                    delay, self.requeue, action)
+            else:
+                self.counts[f'failed {status}'] += 1
+                action.future.set_exception(error)
+        except Exception as error:  # pylint: disable=broad-except
+            DISCORD_CALLS.inc(action.route, 'error')
+            self.counts['failed'] += 1
+            action.future.set_exception(error)
+        else:
+            DISCORD_CALLS.inc(action.route, 'ok')
+            self.counts['sent'] += 1
+            self.sent.append(time.monotonic())
+            action.future.set_result(result)
+        finally:
+            self.running -= 1
+            self.in_flight.release()
+
+    def requeue(self, action):
+        """Puts a retried action back in front of its queue"""
+        self.queues[action.route].appendleft(action)
+        self.wakeup.set()
+
+    async def add_role(self, member, role):
+        """Queues client.add_roles(), skipped if member has the role"""
+        async def call():
+            if role not in member.roles:
+                await self.client.add_roles(member, role)
+
+        return await self.submit(
+            'roles', call, key=('role', member.id, role.id))
+
+    async def remove_role(self, member, role):
+        """Queues client.remove_roles(), skipped if member doesn't have
+        the role
+        """
+        async def call():
+            if role in member.roles:
+                await self.client.remove_roles(member, role)
+
+        return await self.submit(
+            'roles', call, key=('role', member.id, role.id))
+
+    async def kick(self, member):
+        """Queues client.kick()"""
+        return await self.submit(
+            'kick', self.client.kick, member, key=('kick', member.id))
+
+    async def send_message(self, destination, *args, **kwargs):
+        """Queues client.send_message(), DMs go after channel messages"""
+        route = 'message'
+
+        if isinstance(destination, (discord.User, discord.Member)):
+            route = 'dm'
+
+        return await self.submit(
+            route, self.client.send_message, destination, *args, **kwargs)
@@ -20,12 +20,20 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import json
+import time
 import threading
 import asyncio
 import aiohttp
+import discord
 
 from aiohttp import web
-from utils import make_print
+from utils import make_print, is_id
+from jobs import JobManager
+from store import APPROVED, VALID, HAS_KEY
+from events import KEEPALIVE, format_sse
+from metrics import REGISTRY, API_SECONDS
+from tracing import TRACER
 
 
 def print(*args, **kwargs):
@@ -33,46 +41,153 @@ def print(*args, **kwargs):
     return make_print('Server', *args, **kwargs)
 
 
+BATCH_LIMIT = 1000  # IDs per batch request
+FAN_OUT = 8  # Discord follow-ups of a batch, running at once
+WAIT_TIMEOUT = 30  # Default seconds of /user/{id}/wait
+MAX_WAIT_TIMEOUT = 300
+PAGE_SIZE = 500  # Entries read from the store at once, while exporting
+
+# /users query filters and the flags they test
+FILTERS = (('approved', APPROVED), ('valid', VALID), ('has_key', HAS_KEY))
+
+
 class Server:
     """Socket listens for commands, meant for DB interaction"""
-    def __init__(self, loop, store, config, bot):
+    def __init__(self, loop, store, config, bot, intake, events):
         """Create a web server
 
         Register routes and attach it to the main event loop
         """
         self.store = store
         self.bot = bot
+        self.intake = intake
+        self.events = events
+        self.config = config
+        self.jobs = JobManager()  # Discord side of mutating routes
 
         print('Creating an API server on '
               + f'{config.server_ip}:{config.server_port}…')
 
-        app = web.Application()
+        self.add_gauges()
+
+        app = web.Application(middlewares=[self.measure])
         app.add_routes([
             web.get('/user/{id}', self.get_user_by_id),
             web.get('/user/id/{id}', self.get_user_by_id),
+            web.get('/user/{id}/wait', self.wait_for_user),
             web.get('/user/name/{name}/{id}', self.get_user_by_name),
             web.get('/user/add/{id}', self.add_user_by_id),
             web.get('/user/approve/{id}', self.approve_user_by_id),
-            web.get('/user/remove/{id}', self.invalidate_user_by_id)
+            web.get('/user/remove/{id}', self.invalidate_user_by_id),
+            web.get('/users', self.get_users),
+            web.post('/users/batch/get', self.batch_get),
+            web.post('/users/batch/add', self.batch_add),
+            web.post('/users/batch/approve', self.batch_approve),
+            web.get('/jobs/{id}', self.get_job),
+            web.get('/events', self.get_events),
+            web.get('/reconcile', self.reconcile),
+            web.get('/raid', self.get_raid),
+            web.get('/raid/{mode:on|off}', self.set_raid),
+            web.get('/metrics', self.get_metrics),
+            web.get('/stats/scheduler', self.get_scheduler_stats),
+            web.get('/stats/intake', self.get_intake_stats),
+            web.get('/stats/pipeline', self.get_pipeline_stats),
+            web.get('/stats/trace', self.get_trace_stats)
         ])
 
         loop.run_until_complete(loop.create_server(
             app.make_handler(), config.server_ip, config.server_port))
 
+        self.jobs.start()
         print('Server running')
 
+    def add_gauges(self):
+        """Registers gauges, read from the live objects"""
+        gauges = (
+            ('norman_store_entries', 'Entries in the DB',
+             lambda: len(self.store.store.flags)),
+            ('norman_pending_validations', 'Key validations in progress',
+             lambda: len(self.bot.router)),
+            ('norman_pipeline_depth', 'Member events queued or running',
+             lambda: self.bot.pipeline.depth),
+            ('norman_scheduler_queued', 'Outbound Discord calls queued',
+             lambda: sum(len(i) for i in self.bot.scheduler.queues.values())),
+            ('norman_raid_queued', 'Members waiting for admission',
+             lambda: len(self.bot.raid.queue)),
+            ('norman_waiters', 'Long-poll requests waiting',
+             lambda: len(self.bot.waiters)),
+            ('norman_event_subscribers', 'Clients streaming /events',
+             lambda: len(self.events.subscribers)))
+
+        for name, help, read in gauges:
+            REGISTRY.gauge(name, help, read)
+
+    @web.middleware
+    async def measure(self, request, handler):
+        """Observes the latency of every API request, per route"""
+        started = time.monotonic()
+        status = 500
+
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as error:
+            status = error.status
+            raise
+        finally:
+            route = request.match_info.route.resource
+            API_SECONDS.observe(
+                time.monotonic() - started,
+                route.canonical if route else 'unmatched',
+                request.method, str(status))
+
+    async def get_metrics(self, request):
+        """Counters and histograms in the Prometheus text format"""
+        return web.Response(
+            text=REGISTRY.render(), content_type='text/plain')
+
     async def get_user_by_id(self, request):
         """Retreive users DB entry by their ID"""
         user_id = request.match_info['id']
 
         try:
             print(f'Responding to GET get_user_by_id({user_id})')
-            return web.json_response(
-                self.store.get_user(user_id))
+            entry = await self.store.get_user(user_id)
+            return web.json_response(entry.as_dict())
         except KeyError:
             print(f'User - {user_id} not found!')
             return web.HTTPNotFound(reason='User does not exist')
 
+    async def wait_for_user(self, request):
+        """Long-poll, answers once the users validation finishes
+
+        ?until=approved is the only condition so far. ?timeout= seconds
+        to hold the request for, "pending" is returned after them
+        """
+        user_id = request.match_info['id']
+
+        if request.query.get('until', 'approved') != 'approved':
+            raise web.HTTPBadRequest(reason='until must be approved')
+
+        try:
+            timeout = float(request.query.get('timeout', WAIT_TIMEOUT))
+        except ValueError:
+            raise web.HTTPBadRequest(reason='timeout must be a number')
+
+        timeout = min(max(timeout, 0), MAX_WAIT_TIMEOUT)
+
+        if not await self.store.has_entry(user_id):
+            return web.HTTPNotFound(reason='User does not exist')
+
+        if await self.store.is_approved(user_id):
+            outcome = 'approved'
+        else:
+            outcome = await self.bot.waiters.wait(user_id, timeout)
+
+        return web.json_response(
+            {'id': user_id, 'outcome': outcome or 'pending'})
+
     async def get_user_by_name(self, request):
         """Retreive users DB entry by their name"""
         name = request.match_info.get('name', 'noname')
@@ -81,46 +196,321 @@ class Server:
 
         try:
             print(f'Responding to GET get_user_by_id({username})')
-            return web.json_response(
-                self.store.get_user(username))
+            entry = await self.store.get_user(username)
+            return web.json_response(entry.as_dict())
         except KeyError:
             print(f'User - {username} not found!')
             return web.HTTPNotFound(reason='User does not exist')
 
     async def approve_user_by_id(self, request):
-        """Generate an approved DB entry for the specified ID """
+        """Generate an approved DB entry for the specified ID
+
+        Giving the role happens in a job
+        """
         user_id = request.match_info['id']
 
         print(f'Approve user GET requested for {user_id}')
+        self.check_jobs()
         entry = await self.store.add_user(user_id, True)
+        job = self.jobs.submit('approve', user_id, self.approve, user_id)
 
-        return web.json_response(entry)
+        return self.accepted(job, entry)
 
     async def add_user_by_id(self, request):
-        """Generates a DB entry for the specified ID"""
+        """Generates a DB entry for the specified ID
+
+        Requesting the key happens in a job
+        """
         user_id = request.match_info['id']
 
         print(f'Add user GET requested for {user_id}')
+        self.check_jobs()
         entry = await self.store.add_user(user_id, False)
-        member = await self.bot.get_user_by_id(user_id)
-
-        if member:  # Request key, if online
-            await self.bot.request_key(member)
+        job = self.jobs.submit('add', user_id, self.request_key, user_id)
 
-        return web.json_response(entry)
+        return self.accepted(job, entry)
 
     async def invalidate_user_by_id(self, request):
-        """Invalidates a DB entry for the specified ID"""
+        """Invalidates a DB entry for the specified ID
+
+        Kicking and taking the role happens in a job
+        """
         user_id = request.match_info['id']
         print(f'Invalidate GET requested for {user_id}')
-        self.store.invalidate(user_id)
+        self.check_jobs()
+        await self.store.invalidate(user_id)
+        job = self.jobs.submit('remove', user_id, self.kick, user_id)
+
+        return self.accepted(job)
+
+    async def get_users(self, request):
+        """Streams DB entries as newline delimited JSON, ordered by ID
+
+        ?cursor= continues after that ID, the last one of a previous
+        page. ?limit= caps the entries, 0 streams all of them.
+        ?approved=, ?valid= and ?has_key= filter on true / false
+        """
+        query = request.query
+        cursor = query.get('cursor') or None
+        mask = expected = 0
+
+        try:
+            limit = int(query.get('limit', 1000))
+        except ValueError:
+            raise web.HTTPBadRequest(reason='limit must be a number')
+
+        for name, flag in FILTERS:
+            if name not in query:
+                continue
+            elif query[name] not in ('true', 'false'):
+                raise web.HTTPBadRequest(
+                    reason=f'{name} must be true or false')
+
+            mask |= flag
+            expected |= flag if query[name] == 'true' else 0
+
+        print(f'Responding to GET get_users(after {cursor}, {limit})')
+        response = web.StreamResponse(
+            headers={'Content-Type': 'application/x-ndjson'})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
 
-        # Kick the user/Remove role, if online
+        left = limit or float('inf')
+
+        # Page by page, so only PAGE_SIZE entries are ever in memory
+        while left > 0:
+            entries = await self.store.page(
+                cursor, int(min(PAGE_SIZE, left)), mask, expected)
+
+            if not entries:
+                break
+
+            await response.write(''.join(
+                json.dumps({**entry.as_dict(), 'id': user_id}) + '\n'
+                for user_id, entry in entries).encode())
+
+            cursor = entries[-1][0]
+            left -= len(entries)
+
+        await response.write_eof()
+        return response
+
+    async def batch_get(self, request):
+        """Retreive DB entries of a list of IDs"""
+        user_ids = await self.read_ids(request)
+        valid = [i for i in user_ids if is_id(i)]
+
+        print(f'Batch get POST requested for {len(user_ids)} users')
+        entries = dict(zip(valid, await self.store.get_users(valid)))
+
+        return web.json_response(
+            [self.batch_item(i, entries) for i in user_ids])
+
+    async def batch_add(self, request):
+        """Generate DB entries for a list of IDs"""
+        return await self.batch_add_users(request, False)
+
+    async def batch_approve(self, request):
+        """Generate approved DB entries for a list of IDs"""
+        return await self.batch_add_users(request, True)
+
+    async def batch_add_users(self, request, approve):
+        """Writes the entries in one transaction, then queues a job, that
+        runs the Discord side of every ID, FAN_OUT at a time
+        """
+        user_ids = await self.read_ids(request)
+        valid = list(dict.fromkeys(i for i in user_ids if is_id(i)))
+        kind = 'approve' if approve else 'add'
+
+        print(f'Batch {kind} POST requested for {len(user_ids)} users')
+        self.check_jobs()
+        entries = dict(zip(valid, await self.store.add_users(valid, approve)))
+        job = self.jobs.submit(
+            f'batch {kind}', f'{len(valid)} users', self.fan_out,
+            self.approve if approve else self.request_key, valid)
+
+        return web.json_response(
+            [self.batch_item(i, entries) for i in user_ids],
+            status=202, headers={'X-Job-Id': job.id})
+
+    @staticmethod
+    async def read_ids(request):
+        """Returns the IDs, posted as a list or as {"ids": list}"""
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(reason='Body is not JSON')
+
+        if isinstance(body, dict):
+            body = body.get('ids')
+
+        if not isinstance(body, list):
+            raise web.HTTPBadRequest(reason='Expected a list of IDs')
+        elif len(body) > BATCH_LIMIT:
+            raise web.HTTPBadRequest(
+                reason=f'At most {BATCH_LIMIT} IDs per request')
+
+        return [str(i) for i in body]
+
+    @staticmethod
+    def batch_item(user_id, entries):
+        """Per ID status of a batch response"""
+        if not is_id(user_id):
+            return {'id': user_id, 'status': 'invalid'}
+
+        entry = entries.get(user_id)
+
+        if not entry:
+            return {'id': user_id, 'status': 'not_found'}
+        return {'id': user_id, 'status': 'ok', 'user': entry.as_dict()}
+
+    @staticmethod
+    async def fan_out(call, user_ids):
+        """Job, runs call(user_id) for every ID, FAN_OUT at a time"""
+        slots = asyncio.Semaphore(FAN_OUT)
+
+        async def run(user_id):
+            """Runs a single call, holding a slot"""
+            async with slots:
+                try:
+                    return {'id': user_id, **await call(user_id)}
+                except discord.HTTPException as error:
+                    return {'id': user_id, 'error': str(error)}
+
+        return await asyncio.gather(*(run(i) for i in user_ids))
+
+    async def get_events(self, request):
+        """Streams store changes as server-sent events
+
+        ?types=approved,removed picks the events, all of them by default
+        """
+        types = set(filter(None, request.query.get('types', '').split(',')))
+        subscriber = self.events.subscribe(types or None)
+
+        if not subscriber:
+            return web.HTTPServiceUnavailable(reason='Too many subscribers')
+
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache'
+        })
+
+        try:
+            await response.prepare(request)
+
+            while True:
+                events = await subscriber.take(KEEPALIVE)
+
+                if events:
+                    await response.write(
+                        b''.join(format_sse(i) for i in events))
+                else:
+                    await response.write(b': keepalive\n\n')
+        except ConnectionResetError:
+            pass  # Client went away
+        finally:
+            self.events.unsubscribe(subscriber)
+
+        return response
+
+    async def get_job(self, request):
+        """Status of a job, queued by one of the routes above"""
+        job = self.jobs.get(request.match_info['id'])
+
+        if not job:
+            return web.HTTPNotFound(reason='Job does not exist')
+        return web.json_response(job.as_dict())
+
+    def check_jobs(self):
+        """Answers 503, before any writes, if the job queue is full"""
+        if self.jobs.full():
+            raise web.HTTPServiceUnavailable(
+                reason='Too many queued jobs, try again later')
+
+    @staticmethod
+    def accepted(job, entry=None):
+        """202 response, pointing to the job"""
+        body = {'job': job.id, 'status': f'/jobs/{job.id}'}
+
+        if entry:
+            body['user'] = entry.as_dict()
+
+        return web.json_response(body, status=202)
+
+    async def request_key(self, user_id):
+        """Job, requests the key, if the user is on the server"""
         member = await self.bot.get_user_by_id(user_id)
 
-        if member:  # Kick, if arg doesn't block it
-            await self.kick(member)
-            await self.remove_role(
-                member, self.config.roles['approved']['ref'])
+        if not member:
+            return {'online': False, 'requested': False}
+
+        requested = await self.bot.queue_request_key(member)
+        return {'online': True, 'requested': requested}
+
+    async def approve(self, user_id):
+        """Job, gives the approved user its role, if on the server"""
+        member = await self.bot.get_user_by_id(user_id)
+
+        if not member:
+            return {'online': False}
+
+        self.bot.router.cancel(member.id)  # No key needed anymore
+        await self.bot.add_role(
+            member, self.config.roles['approved']['ref'])
+
+        return {'online': True}
+
+    async def kick(self, user_id):
+        """Job, kicks the user and takes its role, if on the server"""
+        member = await self.bot.get_user_by_id(user_id)
+
+        if not member:
+            return {'online': False}
+
+        await self.bot.kick(member)  # Kick, if arg doesn't block it
+        await self.bot.remove_role(
+            member, self.config.roles['approved']['ref'])
+
+        return {'online': True}
+
+    async def reconcile(self, request):
+        """Reconciles the "Approved" role with the DB, on demand"""
+        print('Reconcile GET requested')
+        result = await self.bot.reconciler.reconcile()
+
+        if result is None:
+            return web.HTTPConflict(reason='Already reconciling')
+        return web.json_response(result)
+
+    async def get_raid(self, request):
+        """Raid mode status and admission queue depth"""
+        return web.json_response(self.bot.raid.stats())
+
+    async def set_raid(self, request):
+        """Turns raid mode on or off"""
+        mode = request.match_info['mode']
+        print(f'Raid mode {mode} GET requested')
+
+        if mode == 'on':
+            self.bot.raid.engage(manual=True)
+        else:
+            self.bot.raid.disengage()
+
+        return web.json_response(self.bot.raid.stats())
+
+    async def get_scheduler_stats(self, request):
+        """Outbound Discord call queue depths and counters"""
+        return web.json_response(self.bot.scheduler.stats())
+
+    async def get_intake_stats(self, request):
+        """Member update counts, dropped and coalesced ones included"""
+        return web.json_response(self.intake.stats())
+
+    async def get_pipeline_stats(self, request):
+        """Per member event queue depths and counters"""
+        return web.json_response(self.bot.pipeline.stats())
 
-        return web.HTTPOk()
+    async def get_trace_stats(self, request):
+        """Rolling p50 / p99 of traced handlers and methods"""
+        return web.json_response(
+            {'enabled': TRACER.enabled, 'calls': TRACER.stats()})
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin, import-error
+import dbm
+import sqlite3
+
+from store import Store, Entry, decode_entry
+from utils import SHELVE_PATH, SQLITE_PATH, make_print
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('SQLite', *args, **kwargs)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    id TEXT,
+    name TEXT,
+    avatar_url TEXT,
+    key TEXT,
+    approved INTEGER NOT NULL DEFAULT 0,
+    valid INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_name ON users (name);
+CREATE INDEX IF NOT EXISTS users_key ON users (key);
+CREATE INDEX IF NOT EXISTS users_approved ON users (approved);
+'''
+
+COLUMNS = 'id, name, avatar_url, key, approved, valid'
+
+
+def row_to_entry(row):
+    """Turns a users row, selected with COLUMNS, into a DB entry"""
+    return Entry(row[0], row[1], row[2], row[3], bool(row[4]), bool(row[5]))
+
+
+def entry_to_row(user_id, entry):
+    """Turns a DB entry into a users row"""
+    return (
+        user_id,
+        entry.id,
+        entry.name,
+        entry.avatar_url,
+        entry.key,
+        int(entry.approved),
+        int(entry.valid)
+    )
+
+
+class SqliteStore(Store):
+    """Store backed by a SQLite database, selected with --backend sqlite
+
+    Name, key and approved columns are indexed, so they don't need a
+    separate index. WAL mode lets the API server read, while the bot
+    is writing
+    """
+    def open(self):
+        """Opens the database and creates the schema"""
+        # Opened here, but used from the AsyncStore thread
+        self.db = sqlite3.connect(str(SQLITE_PATH), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+        size = self.db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        print(f'database opened at {str(SQLITE_PATH)}, size: {size}')
+
+        if size == 0:
+            self.import_file()
+
+        self.load_index()  # After the import, so imported rows count too
+
+    def import_file(self):
+        """Copies the users over from the file backend, if there are any"""
+        if not dbm.whichdb(str(SHELVE_PATH)):
+            return
+
+        with dbm.open(str(SHELVE_PATH), 'r') as old:
+            print(f'Importing {len(old)} users from {str(SHELVE_PATH)}…')
+            self.write({key.decode(): decode_entry(old[key])
+                        for key in old.keys()})
+
+    def write(self, entries):
+        """Writes entries in a single transaction"""
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [entry_to_row(k, v) for k, v in entries.items()])
+
+    def load_index(self):
+        """Loads the in-memory index with a single query"""
+        rows = self.db.execute(f'SELECT user_id, {COLUMNS} FROM users')
+
+        for row in rows:
+            self.index_entry(row[0], row_to_entry(row[1:]), False)
+
+        self.sorted_ids = sorted(self.flags)
+
+    def fetch(self, user_id):
+        """Returns the entry under user_id from the database"""
+        row = self.db.execute(
+            f'SELECT {COLUMNS} FROM users WHERE user_id = ?',
+            (str(user_id),)).fetchone()
+
+        if row is None:
+            raise KeyError(user_id)
+        return row_to_entry(row)
+
+    def ids(self):
+        """Returns every ID in the database, not counting the dirty ones"""
+        rows = self.db.execute('SELECT user_id FROM users')
+        return [row[0] for row in rows]
+
+    def close(self):
+        """Flushes the write-back cache and closes the database"""
+        print('Closing the store…')
+        self.flush()
+        self.db.close()
+
+    def rebuild_index(self):
+        """Names are an indexed column, nothing to rebuild"""
+
+    def reindex(self, user_id, old_name, new_name, created):
+        """Names are an indexed column, nothing to move"""
+
+    def lookup_name(self, name):
+        """Returns the ID of the entry named name
+
+        Dirty entries are newer than the database, so they're checked
+        first and rows they shadow are skipped
+        """
+        for user_id, entry in self.dirty.items():
+            if entry.name == name:
+                return user_id
+
+        rows = self.db.execute(
+            'SELECT user_id FROM users WHERE name = ?', (name,))
+
+        for (user_id,) in rows:
+            if user_id not in self.dirty:
+                return user_id
+        raise KeyError(name)
+
+    def get_approved_users(self):
+        """Returns every approved entry"""
+        self.flush()
+        rows = self.db.execute(
+            f'SELECT {COLUMNS} FROM users WHERE approved = 1')
+        return [row_to_entry(row) for row in rows]
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin
+import os
+import json
+
+from utils import make_print
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('State', *args, **kwargs)
+
+
+def load_state(path, default=None):
+    """Returns the JSON state saved at path, default if there's none
+
+    A corrupt file counts as none, the state is only an optimization
+    """
+    try:
+        with open(str(path)) as state:
+            return json.load(state)
+    except FileNotFoundError:
+        pass
+    except ValueError as error:
+        print(f'Ignoring unreadable state in {str(path)} - {error}')
+
+    return default
+
+
+def save_state(path, data):
+    """Writes data to path as JSON
+
+    Written to a temporary file, then moved over the old one, so a crash
+    never leaves half of a state behind
+    """
+    tmp = f'{str(path)}.tmp'
+
+    with open(tmp, 'w') as state:
+        json.dump(data, state)
+        state.flush()
+        os.fsync(state.fileno())
+
+    os.replace(tmp, str(path))
@@ -20,12 +20,20 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-# pylint: disable=redefined-builtin, import-error
+# pylint: disable=redefined-builtin, import-error, too-many-arguments
+import time
+import dbm
+import pickle
 import shelve
+import bisect
+import struct
+import contextlib
 import discord
 
 from utils import (
     SHELVE_PATH,
+    DEBUG,
+    NAMES_PATH,
     make_print,
     make_key,
     is_id,
@@ -38,6 +46,113 @@ def print(*args, **kwargs):
     return make_print('Store', *args, **kwargs)
 
 
+# Reserved name index key, holds the user count the index was built against
+INDEX_SIZE = '\0size'
+
+# Encoded entry layout - version, flags, lengths of id, name, avatar_url
+# and key, followed by those strings in utf-8. NONE_LENGTH stands for None
+ENTRY_VERSION = 1
+ENTRY_HEADER = struct.Struct('<BB4H')
+NONE_LENGTH = 0xffff
+
+# Entry flags, HAS_KEY is only used by the in-memory index
+APPROVED = 1
+VALID = 2
+HAS_KEY = 4
+
+
+class Entry:
+    """Compact DB entry
+
+    Stored with encode(), which packs approved and valid into a flag
+    byte, so flag checks don't need to decode the strings
+    """
+    __slots__ = ('id', 'name', 'avatar_url', 'key', 'approved', 'valid')
+
+    def __init__(
+            self,
+            user_id=None,
+            name=None,
+            avatar_url=None,
+            key=None,
+            approved=False,
+            valid=False
+    ):
+        self.id = user_id  # pylint: disable=invalid-name
+        self.name = name
+        self.avatar_url = avatar_url
+        self.key = key
+        self.approved = approved
+        self.valid = valid
+
+    def copy(self):
+        """Returns a copy of this entry"""
+        return Entry(self.id, self.name, self.avatar_url, self.key,
+                     self.approved, self.valid)
+
+    def flags(self):
+        """Returns approved, valid and key presence as flag bits"""
+        return (APPROVED if self.approved else 0) \
+            | (VALID if self.valid else 0) \
+            | (HAS_KEY if self.key else 0)
+
+    def as_dict(self):
+        """Returns the entry as a dict, in the format of the API"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'avatar_url': self.avatar_url,
+            'key': self.key,
+            'approved': self.approved,
+            'valid': self.valid
+        }
+
+    @classmethod
+    def from_dict(cls, entry):
+        """Builds an entry out of the dicts, older versions pickled"""
+        return cls(entry['id'], entry['name'], entry['avatar_url'],
+                   entry['key'], entry['approved'], entry['valid'])
+
+    def encode(self):
+        """Packs the entry into bytes"""
+        strings = [None if i is None else str(i).encode()
+                   for i in (self.id, self.name, self.avatar_url, self.key)]
+        header = ENTRY_HEADER.pack(
+            ENTRY_VERSION,
+            self.flags(),
+            *(NONE_LENGTH if i is None else len(i) for i in strings))
+
+        return header + b''.join(i for i in strings if i)
+
+    @classmethod
+    def decode(cls, data):
+        """Unpacks an entry, packed by encode()"""
+        _, flags, *lengths = ENTRY_HEADER.unpack_from(data)
+        offset = ENTRY_HEADER.size
+        strings = []
+
+        for length in lengths:
+            if length == NONE_LENGTH:
+                strings.append(None)
+            else:
+                strings.append(data[offset:offset + length].decode())
+                offset += length
+
+        return cls(*strings, bool(flags & APPROVED), bool(flags & VALID))
+
+
+def is_encoded(data):
+    """Returns true, if data was packed by Entry.encode()"""
+    return data[0] == ENTRY_VERSION
+
+
+def decode_entry(data):
+    """Decodes an entry, packed or pickled by older versions"""
+    if is_encoded(data):
+        return Entry.decode(data)
+    return Entry.from_dict(pickle.loads(data))
+
+
 def make_entry(
         user_id=None,
         name=None,
@@ -47,61 +162,295 @@ def make_entry(
         valid=False
 ):
     """Template for the DB entry"""
-    return {
-        'id': user_id,
-        'name': name,
-        'avatar_url': avatar_url,
-        'key': key,
-        'approved': approved,
-        'valid': valid
-    }
+    return Entry(user_id, name, avatar_url, key, approved, valid)
+
+
+def entry_events(old, new):
+    """Returns names of the changes from old to new, for subscribers
+
+    old is None for a new entry
+    """
+    if new.id is None and not new.key and not new.name:
+        return ['removed']  # Zeroed out
+
+    events = []
+
+    if old is None:
+        events.append('created')
+    if new.key and new.key != getattr(old, 'key', None):
+        events.append('key_assigned')
+    if new.approved and not getattr(old, 'approved', False):
+        events.append('approved')
+    if old is not None and old.approved and not new.approved:
+        events.append('unapproved')
+    # Entries approved by ID may have never been valid
+    if old is not None and not new.valid \
+       and (old.valid or old.approved and not new.approved):
+        events.append('invalidated')
+
+    return events
 
 
 class Store:
-    """Store type class around self.shelve
+    """Store type class around self.db
+
+    Storage specific parts live in open(), write(), fetch(), close() and
+    the name index methods, so other backends can subclass this
 
     Approve new users with "!approve Someone#1245" from discord with admin
     permissions everytime a user joins, DB is queried to check if the
     user.id.approved == True
 
-    Dictionary follows the format of key<Long>: {
-                                            name: String,
-                                            approved: Boolean,
-                                            key: String
-                                          }
+    Entries are stored packed by Entry.encode(), under their ID. Dicts
+    pickled by older versions get converted, as they're read
     """
-    def __init__(self):
-        self.shelve = shelve.open(str(SHELVE_PATH))
-        print(f'shelve opened at {str(SHELVE_PATH)}, size: {len(self.shelve)}')
+    def __init__(self, args):
+        # Write-back cache, entries here are newer than the ones on disk
+        # and get written out in one batch by self.flush()
+        self.dirty = {}
+        self.sync_interval = args.sync_interval
+        self.sync_limit = args.sync_limit
+        self.last_sync = time.monotonic()
+        self.batching = 0  # Syncs wait, while inside self.batch()
+        self.listeners = []  # Called with (event, ID, entry) on changes
+
+        # In-memory index of every entry, answers the predicates used on
+        # every member update without touching the disk. Written only by
+        # self.put(), so it's always as new as the dirty entries
+        self.flags = {}  # ID -> flags
+        self.name_hashes = {}  # ID -> hash(name)
+        self.sorted_ids = []  # Every ID of the index, in order, for pages
+
+        self.open()
+
+    def open(self):
+        """Opens the DB and checks if the name index is fresh"""
+        self.db = dbm.open(str(SHELVE_PATH), 'c')
+        self.names = shelve.open(str(NAMES_PATH))  # name -> ID index
+        self.size = len(self.db)
+        print(f'DB opened at {str(SHELVE_PATH)}, size: {self.size}')
+
+        if self.names.get(INDEX_SIZE) != self.size:
+            self.rebuild_index()
+
+        self.load_index()
+
+    def load_index(self):
+        """Loads flags and name hashes of every entry into memory"""
+        for user_id in self.ids():
+            self.index_entry(user_id, self.fetch(user_id), False)
+
+        self.sorted_ids = sorted(self.flags)
+
+    def index_entry(self, user_id, entry, sort=True):
+        """Updates the in-memory index for entry
+
+        sort=False leaves new IDs out of self.sorted_ids, for loaders,
+        which sort every ID at once
+        """
+        if sort and user_id not in self.flags:
+            bisect.insort(self.sorted_ids, user_id)
+
+        self.flags[user_id] = entry.flags()
+        self.name_hashes[user_id] = hash(entry.name)
 
     def sync(self):
-        """Sync shortcut"""
-        self.shelve.sync()
+        """Flushes dirty entries, once enough of them piled up
+
+        Called after every mutation, the actual write happens every
+        self.sync_limit entries or self.sync_interval seconds
+        """
+        if self.batching:
+            return  # self.batch() flushes, once it's done
+
+        if len(self.dirty) >= self.sync_limit \
+           or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes every dirty entry to disk"""
+        if self.dirty:
+            print(f'Flushing {len(self.dirty)} dirty entries', level=DEBUG)
+
+        self.write(self.dirty)
+        self.dirty.clear()
+        self.last_sync = time.monotonic()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Groups mutations into one flush, one transaction on SQLite"""
+        self.batching += 1
+
+        try:
+            yield self
+        finally:
+            self.batching -= 1
+
+            if not self.batching:
+                self.flush()
+
+    def write(self, entries):
+        """Writes packed entries to the DB and syncs it"""
+        for user_id, entry in entries.items():
+            self.db[user_id] = entry.encode()
+
+        if hasattr(self.db, 'sync'):  # Not every dbm module has it
+            self.db.sync()
+        self.names.sync()
+
+    def fetch(self, user_id):
+        """Returns the entry under user_id from the DB
+
+        Pickled entries are queued up to be written back packed
+        """
+        data = self.db[user_id]
+        entry = decode_entry(data)
+
+        if not is_encoded(data):
+            self.dirty[user_id] = entry.copy()
+        return entry
+
+    def ids(self):
+        """Returns every ID in the DB, not counting the dirty ones"""
+        return [key.decode() for key in self.db.keys()]
+
+    def close(self):
+        """Flushes the write-back cache and closes the DB"""
+        print('Closing the store…')
+        self.flush()
+        self.db.close()
+        self.names.close()
+
+    def rebuild_index(self):
+        """Rebuilds the name -> ID index from every DB entry
+
+        Called when the index is missing or was built against a different
+        user count, e.g. the DB was edited while the bot was off
+        """
+        print(f'Rebuilding the name index of {self.size} entries…')
+
+        self.flush()
+        self.names.clear()
+
+        for key in self.ids():
+            name = self.fetch(key).name
+
+            if name:
+                self.names[name] = key
+
+        self.names[INDEX_SIZE] = self.size
+        self.names.sync()
+
+    def reindex(self, user_id, old_name, new_name, created):
+        """Moves user_id in the name index from old_name to new_name"""
+        if created:
+            self.size += 1
+            self.names[INDEX_SIZE] = self.size
+
+        if old_name == new_name:
+            return
+
+        if old_name and self.names.get(old_name) == user_id:
+            del self.names[old_name]
+
+        if new_name:
+            self.names[new_name] = user_id
+
+    def read(self, user_id):
+        """Returns the entry under user_id, dirty or from the disk
+
+        Raises KeyError, if there is none. Dirty entries are copied, so
+        callers can't modify the cache without self.put(), same as with
+        entries decoded from the disk
+        """
+        try:
+            return self.dirty[user_id].copy()
+        except KeyError:
+            return self.fetch(user_id)
+
+    def put(self, user_id, entry):
+        """Queues the entry for the next flush and keeps the name index
+        in sync
+        """
+        try:
+            old = self.read(user_id)
+        except KeyError:
+            old = None
+
+        self.dirty[user_id] = entry
+        self.index_entry(user_id, entry)
+        self.reindex(
+            user_id, getattr(old, 'name', None), entry.name, old is None)
+
+        if self.listeners:
+            self.publish(user_id, old, entry)
 
-    async def remove_user(self, target):
+    def subscribe(self, listener):
+        """Calls listener(event, user_id, entry) after every change
+
+        Listeners run on whichever thread writes, keep them quick
+        """
+        self.listeners.append(listener)
+
+    def publish(self, user_id, old, new):
+        """Tells the listeners what changed about user_id"""
+        for event in entry_events(old, new):
+            for listener in self.listeners:
+                listener(event, user_id, new.copy())
+
+    def lookup_name(self, name):
+        """Returns the ID indexed under name
+
+        A hit, whose entry no longer carries that name, means the index
+        went stale, so it gets rebuilt and queried once more
+        """
+        user_id = self.names[name]
+
+        try:
+            if self.read(user_id).name == name:
+                return user_id
+        except KeyError:
+            pass
+
+        self.rebuild_index()
+        return self.names[name]
+
+    def get_approved_users(self):
+        """Returns every approved entry"""
+        return [self.read(user_id) for user_id, flags in self.flags.items()
+                if flags & APPROVED]
+
+    def remove_user(self, target):
         """Removes user from the shelf"""
         try:
-            for key in self.shelve:
-                if self.shelve[key]['name'] == str(target):
-                    print(f'Invalidating DB entry, ID - {key}')
-                    self.shelve[key] = make_entry()
-                    self.sync()
-                    return True
+            user_id = self.lookup_name(str(target))
+            print(f'Invalidating DB entry, ID - {user_id}')
+            self.put(user_id, make_entry())
+            self.sync()
+            return True
         except KeyError:
             pass
         return False
 
-    async def remove_user_by_id(self, user_id):
+    def remove_user_by_id(self, user_id):
         """Removes user, using their ID"""
         try:
-            self.shelve[str(user_id)] = make_entry()  # Empty entry
+            self.put(str(user_id), make_entry())  # Empty entry
             self.sync()
             return True
         except KeyError:
             pass
         return False
 
-    async def add_user(self, user, approve=False):
+    def remove_users_by_id(self, user_ids):
+        """Removes every user in user_ids, flushing them in one go"""
+        for user_id in user_ids:
+            self.put(str(user_id), make_entry())  # Empty entry
+
+        self.flush()
+        return len(user_ids)
+
+    def add_user(self, user, approve=False):
         """Stores user in the shelf """
         using_id_only = False
         name = None
@@ -127,63 +476,117 @@ class Store:
         # just assign $approve
         try:
             entry = self.get_user(user)  # NOTE: User can also be an ID
-            entry['approved'] = approve
+            entry.approved = approve
             print(f'An entry for {user} already exists, '
-                  + f'switching approved to {approve}')
+                  + f'switching approved to {approve}', level=DEBUG)
 
             # Somethimes DB entry is invalidated, regenerate its key
-            if not entry['key']:
-                print(f'User does not have a key, assigning it now')
-                entry['key'] = make_key()
+            if not entry.key:
+                print('User does not have a key, assigning it now',
+                      level=DEBUG)
+                entry.key = make_key()
 
             if not using_id_only:
                 try:
-                    print(f'Also forcing an update for {name}…')
+                    print(f'Also forcing an update for {name}…',
+                          level=DEBUG)
                     entry = self.update_user_entry(user, entry)
                 except AttributeError:
                     pass  # Update later
 
-            self.shelve[user_id] = entry
+            self.put(user_id, entry)
             self.sync()
-            return self.shelve[user_id]
+            return entry
         except KeyError:
             pass
 
-        self.shelve[user_id] = make_entry(
-            user_id, name, avatar_url, make_key(), approve)
+        self.put(user_id, make_entry(
+            user_id, name, avatar_url, make_key(), approve))
 
         print(f'Manually approved user {name}, ID - {user_id}')
 
-        self.shelve.sync()
-        return self.shelve[user_id]
+        self.sync()
+        return self.read(user_id)
+
+    def add_users(self, user_ids, approve=False):
+        """add_user() for every ID, written in one batch"""
+        with self.batch():
+            return [self.add_user(i, approve) for i in user_ids]
+
+    def get_users(self, user_ids):
+        """Returns entries of user_ids, None for the missing ones"""
+        entries = []
+
+        for user_id in user_ids:
+            try:
+                entries.append(self.read(str(user_id)))
+            except KeyError:
+                entries.append(None)
+
+        return entries
+
+    def page(self, cursor=None, limit=100, mask=0, expected=0):
+        """Returns up to limit (ID, entry) pairs, with IDs after cursor,
+        in order. Zeroed entries don't carry their ID, hence the pairs
+
+        Filtered on the index, entries are kept, if their
+        flags & mask == expected. Pages start at a bisect of the sorted
+        IDs, so walking the whole store reads every ID once
+        """
+        start = 0
+
+        if cursor is not None:
+            start = bisect.bisect_right(self.sorted_ids, cursor)
+
+        user_ids = []
+
+        for i in range(start, len(self.sorted_ids)):
+            if len(user_ids) >= limit:
+                break
+
+            user_id = self.sorted_ids[i]
+
+            if self.flags[user_id] & mask == expected:
+                user_ids.append(user_id)
+
+        return [(i, self.read(i)) for i in user_ids]
+
+    def has_entry(self, user_id):
+        """Returns true, if there is an entry under user_id"""
+        return user_id in self.flags
 
     def make_user_blank_entry(self, member):
         """Creates an empty entry for a new user"""
-        try:
-            if self.shelve[member.id]:
-                return False
-            return True
-        except KeyError:  # If it doesn't create a new entry
-            self.shelve[member.id] = make_entry(
-                member.id, member.name, get_avatar_url(member))
-            return True
+        if self.has_entry(member.id):
+            return False
+
+        self.put(member.id, make_entry(
+            member.id, member.name, get_avatar_url(member)))
+        self.sync()
+        return True
 
     def get_user_key(self, member):
-        """Returns true, if user has key"""
+        """Returns the key of the user, None if there is none"""
         try:
-            entry = self.shelve[member.id]
+            entry = self.read(member.id)
 
-            return entry['key']  # Will be NoneType, if no key
+            return entry.key  # Will be NoneType, if no key
         except KeyError:
             pass
         return None
 
+    def has_key(self, member):
+        """Returns true, if user has key"""
+        user_id = str(member)
+
+        if isinstance(member, (discord.User, discord.Member)):
+            user_id = member.id
+
+        return bool(self.flags.get(user_id, 0) & HAS_KEY)
+
     def is_valid(self, member):
         """Returns true if DB entry is valid"""
-        try:
-            return self.get_user(member)['valid']
-        except KeyError:
-            return False
+        return bool(self.flags.get(member.id, 0) & VALID)
 
     def is_approved(self, member):
         """Returns approved bool associated with member.id"""
@@ -192,17 +595,15 @@ class Store:
         if isinstance(member, (discord.User, discord.Member)):
             user_id = member.id
 
-        try:
-            entry = self.shelve[user_id]
+        # Unknown member - not approved
+        return bool(self.flags.get(user_id, 0) & APPROVED)
 
-            if entry['approved']:
-                return True
-        except KeyError:  # Unknown member - not approved
-            pass
-        return False
+    def approved_ids(self):
+        """Returns a set of every approved ID, from the index"""
+        return {i for i, flags in self.flags.items() if flags & APPROVED}
 
     def get_user(self, user):
-        """Fetches shelve key by user.id"""
+        """Fetches DB entry by user.id"""
         user_id = None
 
         # If a user object provided, pull the ID from that
@@ -211,36 +612,37 @@ class Store:
         elif is_id(user):  # Lookup by ID
             user_id = str(user)
         elif isinstance(user, str):  # Lookup by name
-            for key in self.shelve:
-                if self.shelve[key]['name'] == user:
-                    return self.shelve[key]
+            user_id = self.lookup_name(user)
 
         try:
-            return self.shelve[user_id]
+            return self.read(user_id)
         except KeyError:
             raise
 
     def get_user_id(self, name):
-        """Iterates over the DB and returns ID of matched name"""
-        for i in self.shelve:
-            if self.shelve[i]['name'] == name:
-                return i
-        # Else raise a KeyError
-        raise KeyError('Name not found in the database')
+        """Returns ID of matched name, using the name index"""
+        try:
+            return self.lookup_name(name)
+        except KeyError:
+            raise KeyError('Name not found in the database')
 
     def does_key_match(self, user, key):
-        """Compares the strings of key and entry['key']"""
+        """Compares the strings of key and entry.key"""
         try:
             entry = self.get_user(user)
 
-            if key == entry['key']:
+            if key == entry.key:
                 return True
         except KeyError:
             pass
         return False
 
     def invalidate(self, member, keep_key=False):
-        """Invalidate members DB entry"""
+        """Invalidate members DB entry
+
+        With keep_key, invalidating by ID keeps the name and avatar too,
+        so the entry can still be found by its name
+        """
         print(f'Invalidating {member} DB entry')
 
         using_id_only = True
@@ -250,24 +652,25 @@ class Store:
             using_id_only = False
             user_id = member.id
 
-        key = None
+        key = name = avatar_url = None
 
         if keep_key:
-            key = self.shelve[user_id]['key']
-            print(f'    Keeping the key - {key}')
+            old = self.read(user_id)
+            key, name, avatar_url = old.key, old.name, old.avatar_url
+            print(f'    Keeping the key - {key}', level=DEBUG)
 
         # id, name, key, approved, valid
         if using_id_only:
-            self.shelve[user_id] = make_entry(
-                user_id, None, None, key, False)
+            self.put(user_id, make_entry(
+                user_id, name, avatar_url, key, False))
         else:
-            self.shelve[user_id] = make_entry(
+            self.put(user_id, make_entry(
                 member.id,
                 member.name,
                 get_avatar_url(member),
                 key,
                 False
-            )
+            ))
 
         self.sync()
 
@@ -277,9 +680,9 @@ class Store:
         Return success True/False
         """
         try:
-            entry = self.shelve[user_id]
-            entry['name'] = new_name
-            self.shelve[user_id] = entry
+            entry = self.read(user_id)
+            entry.name = new_name
+            self.put(user_id, entry)
             self.sync()
 
             return True
@@ -292,15 +695,16 @@ class Store:
         """Returns true, if current user ID name does
         not match with the one in the DB"""
         try:
-            return self.shelve[user_id]['name'] != current_name
+            return self.name_hashes[user_id] != hash(current_name)
         except KeyError:
-            print(f'Tried to compare a nonexistent ID entry - {user_id}')
+            print(f'Tried to compare a nonexistent ID entry - {user_id}',
+                  level=DEBUG)
         return True
 
     def get_user_by_id(self, user_id):
         """Fetches DB entry by ID"""
         try:
-            return self.shelve[user_id]
+            return self.read(user_id)
         except KeyError:
             return None
 
@@ -315,22 +719,22 @@ class Store:
 
         entry_provided = True
 
-        print(f'Updating entry ID - {member.id}')
+        print(f'Updating entry ID - {member.id}', level=DEBUG)
 
         # Support passing in an entry, to avoid useless query
         if not entry:
             entry = self.get_user(member)
             entry_provided = False
 
-        entry['id'] = member.id
-        entry['name'] = str(member)
-        entry['avatar_url'] = get_avatar_url(member)
-        entry['valid'] = True
+        entry.id = member.id
+        entry.name = str(member)
+        entry.avatar_url = get_avatar_url(member)
+        entry.valid = True
 
         # If an entry provided from an outter scope, leave the
         # update duty to that
-        if entry_provided:
-            self.shelve[member.id] = entry
+        if not entry_provided:
+            self.put(member.id, entry)
             self.sync()
 
         return entry
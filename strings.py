@@ -39,6 +39,11 @@ WRONG_CHANNEL = "Command used in the wrong channel"
 ALREADY_APPROVED = "**{}**: Already Approved\n**Key:** {}"
 YOU_WERE_DELETED = "Your key was deleted from the server"
 HEY = "Hey, **<@{}>** :flushed:"
+RECONCILED = "Reconciled roles, **{}** granted, **{}** revoked"
+RECONCILING = "Already reconciling roles, try again later"
+RAID_ON = "Raid mode is **on**, **{}** members waiting for admission"
+RAID_OFF = "Raid mode is **off**, **{}** members waiting for admission"
+NO_STATS = "Nothing traced yet, is the bot running with `--trace`?"
 GOT_BOT_ROLE = "Okay, received the bot role"
 BOT_ROLE_LACKS_PERMS = ", tho its missing {} permissions. I kinda need them" \
     + ", to do my work…"
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin
+import time
+import asyncio
+import functools
+import contextlib
+import contextvars
+import collections
+
+from utils import WARNING, make_print
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('Trace', *args, **kwargs)
+
+
+WINDOW = 1024  # Latest calls, the percentiles are taken from
+
+# Span of whatever the current task is running, children find their
+# parent trough it, even across asyncio.gather()
+CURRENT = contextvars.ContextVar('span', default=None)
+
+
+class Span:
+    """Single traced call"""
+    __slots__ = ('category', 'started', 'children', 'parent', 'breakdown')
+
+    def __init__(self, category, parent):
+        self.category = category
+        self.started = time.monotonic()
+        self.children = 0.0  # Seconds spent in traced calls below
+        self.parent = parent
+
+        # Exclusive seconds per category, shared by the whole event
+        self.breakdown = parent.breakdown if parent \
+            else collections.Counter()
+
+
+def percentile(ordered, fraction):
+    """Returns the value at fraction of the sorted list"""
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Tracer:
+    """Opt-in latency tracing, turned on with --trace
+
+    Every traced call records its latency under its name, so rolling
+    percentiles can be reported. Events also add up the time their
+    calls spent in each category, exclusive of the calls below them,
+    which gets logged for events over --slow-event-ms
+    """
+    def __init__(self):
+        self.enabled = False
+        self.slow = 0  # Seconds
+        self.latencies = {}  # Name -> deque of the latest seconds
+        self.counts = collections.Counter()
+
+    def enable(self, slow_ms):
+        """Starts tracing"""
+        self.enabled = True
+        self.slow = slow_ms / 1000
+        print(f'Tracing on, logging events slower than {slow_ms}ms')
+
+    def stats(self):
+        """Returns count, p50, p99 and max in ms, per traced name"""
+        stats = {}
+
+        for name, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            stats[name] = {
+                'count': self.counts[name],
+                'p50_ms': round(percentile(ordered, .5) * 1000, 2),
+                'p99_ms': round(percentile(ordered, .99) * 1000, 2),
+                'max_ms': round(ordered[-1] * 1000, 2)
+            }
+
+        return stats
+
+    def record(self, name, seconds):
+        """Keeps seconds in the rolling window of name"""
+        latencies = self.latencies.get(name)
+
+        if latencies is None:
+            latencies = self.latencies[name] = collections.deque(
+                maxlen=WINDOW)
+
+        latencies.append(seconds)
+        self.counts[name] += 1
+
+    @contextlib.contextmanager
+    def span(self, name, category, event=False):
+        """Traces the calls inside, events start a new breakdown"""
+        parent = None if event else CURRENT.get()
+        span = Span(category, parent)
+        token = CURRENT.set(span)
+
+        try:
+            yield span
+        finally:
+            CURRENT.reset(token)
+            duration = time.monotonic() - span.started
+            self.record(name, duration)
+
+            # Overlapping children, from gather(), can outgrow the parent
+            span.breakdown[category] += max(duration - span.children, 0)
+
+            if parent:
+                parent.children += duration
+            elif event and duration >= self.slow:
+                self.log_slow(name, duration, span.breakdown)
+
+    @staticmethod
+    def log_slow(name, duration, breakdown):
+        """Logs where the time of a slow event went"""
+        parts = ', '.join(
+            f'{category} {seconds * 1000:.0f}ms'
+            for category, seconds in breakdown.most_common())
+
+        print(f'Slow {name}, {duration * 1000:.0f}ms - {parts}',
+              level=WARNING)
+
+    def wrap(self, call, name, category):
+        """Returns coroutine function call, traced as name"""
+        @functools.wraps(call)
+        async def wrapper(*args, **kwargs):
+            with self.span(name, category):
+                return await call(*args, **kwargs)
+        return wrapper
+
+    def instrument(self, obj, category, prefix, names=None):
+        """Traces public coroutine methods of obj, or only names"""
+        for name in names or dir(type(obj)):
+            method = getattr(obj, name)
+
+            if not name.startswith('_') \
+               and asyncio.iscoroutinefunction(method):
+                setattr(obj, name, self.wrap(
+                    method, f'{prefix}.{name}', category))
+
+
+TRACER = Tracer()
+
+
+def traced(handler):
+    """Decorates an event handler, tracing it, when tracing is on"""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        if not TRACER.enabled:
+            return await handler(*args, **kwargs)
+
+        with TRACER.span(name, 'handler', event=True):
+            return await handler(*args, **kwargs)
+    return wrapper
@@ -21,8 +21,7 @@ THE SOFTWARE.
 """
 
 # pylint: disable=import-error
-from __future__ import print_function
-import builtins as __builtin__
+import logging
 
 from pathlib import Path
 from random import getrandbits
@@ -35,6 +34,11 @@ DESCRIPTION = 'Example: ./__main__.py -v --config ./config_2.txt --print-only'
 PWD = Path(__file__).parent
 CONFIG_PATH = PWD / 'config.json'
 SHELVE_PATH = PWD / 'users'
+NAMES_PATH = PWD / 'users.names'
+SQLITE_PATH = PWD / 'users.sqlite3'
+PENDING_PATH = PWD / 'users.pending'
+BANS_PATH = PWD / 'bans.json'
+SNAPSHOT_PATH = PWD / 'snapshot.json'
 
 N = '\n'
 RED = discord.Colour.red()
@@ -42,21 +46,27 @@ YELLOW = discord.Colour.orange()
 GREEN = discord.Colour.green()
 
 
-def make_print(prefix, *args, **kwargs):
-    """Prefixes will let more easily differentiate the debug logs"""
-    return __builtin__.print(prefix + ':', *args, **kwargs)
+DEBUG = logging.DEBUG
+WARNING = logging.WARNING
 
 
-def new_line():
-    """Defining newline, because print is getting overridden above"""
-    return print('')
+def make_print(prefix, *args, level=logging.INFO, sep=' ', exc_info=None,
+               **_):
+    """Logs args under the norman.<prefix> logger
+
+    Prefixes will let more easily differentiate the debug logs
+    """
+    logger = logging.getLogger(f'norman.{prefix}')
+
+    if logger.isEnabledFor(level):
+        logger.log(level, sep.join(str(i) for i in args), exc_info=exc_info)
 
 
 def make_key():
     """Returns a random key"""
     key = getrandbits(128)
 
-    print(f'Random key generated - {key}')
+    make_print('Utils', 'Random key generated', level=DEBUG)
     return str(key)
 
 
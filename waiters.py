@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+""" Copyright (C) 2018 github.com/volskaya
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+# pylint: disable=redefined-builtin
+import asyncio
+
+from utils import make_print
+
+
+def print(*args, **kwargs):
+    """Prefix builtin print"""
+    return make_print('Waiters', *args, **kwargs)
+
+
+class Waiters:
+    """Long-poll requests, waiting for a validation to finish
+
+    Every user has at most one future, shared by all of its waiters.
+    It's resolved by whoever finishes the validation, nothing polls
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.waiting = {}  # ID -> [future, waiter count]
+
+    def __len__(self):
+        return sum(i[1] for i in self.waiting.values())
+
+    async def wait(self, user_id, timeout):
+        """Returns the outcome for user_id, None after timeout seconds"""
+        held = self.waiting.get(user_id)
+
+        if held is None:
+            held = self.waiting[user_id] = [self.loop.create_future(), 0]
+
+        held[1] += 1
+
+        try:  # Shielded, a waiter timing out leaves the future to others
+            return await asyncio.wait_for(asyncio.shield(held[0]), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            held[1] -= 1
+
+            if not held[1] and self.waiting.get(user_id) is held:
+                del self.waiting[user_id]
+
+    def resolve(self, user_id, outcome):
+        """Wakes every waiter of user_id with outcome"""
+        held = self.waiting.pop(user_id, None)
+
+        if held and not held[0].done():
+            held[0].set_result(outcome)
+
+    def on_store_event(self, event, user_id, entry):
+        """Store listener, approvals from anywhere end the wait too"""
+        if event == 'approved':
+            self.loop.call_soon_threadsafe(
+                self.resolve, user_id, 'approved')